@@ -0,0 +1,264 @@
+"""
+Seed a synthetic database and print query plans and latencies for the hot
+lookups of the timeline, pull list and webhook handlers, once without and once
+with the secondary indexes defined on the models.
+
+    python benchmarks/query_plans.py
+    python benchmarks/query_plans.py --url postgresql://localhost/apogee_bench
+"""
+
+import datetime
+import random
+import statistics
+import time
+from typing import Callable
+
+import click
+import sqlalchemy as sa
+from sqlalchemy.engine import Engine
+
+from apogee.model import db as model
+from apogee.model.db import db
+
+SECONDARY_INDEXES = [
+    index for table in db.metadata.sorted_tables for index in table.indexes
+]
+
+
+def seed(
+    engine: Engine, n_commits: int, n_pulls: int, pipelines: int, jobs: int
+) -> None:
+    rng = random.Random(42)
+    start = datetime.datetime(2023, 1, 1)
+
+    def chunked(rows: list[dict], size: int = 5000):
+        for i in range(0, len(rows), size):
+            yield rows[i : i + size]
+
+    with engine.begin() as conn:
+        conn.execute(
+            sa.insert(model.GitHubUser.__table__),
+            [
+                dict(
+                    id=i,
+                    login=f"user{i}",
+                    url=f"https://api.github.com/users/user{i}",
+                    html_url=f"https://github.com/user{i}",
+                    avatar_url="https://avatars.githubusercontent.com/u/1",
+                )
+                for i in range(50)
+            ],
+        )
+
+        commits = []
+        for i in range(n_commits):
+            # a third of all commits only exist on pull request branches
+            on_main = i % 3 != 0
+            commits.append(
+                dict(
+                    sha=f"{i:040x}",
+                    url="",
+                    html_url="",
+                    author_id=rng.randrange(50),
+                    committer_id=rng.randrange(50),
+                    commit_author="author",
+                    commit_committer="committer",
+                    message=f"commit {i}",
+                    committed_date=start + datetime.timedelta(minutes=i),
+                    authored_date=start + datetime.timedelta(minutes=i),
+                    note="",
+                    revert=False,
+                    order=i if on_main else -1,
+                )
+            )
+        for rows in chunked(commits):
+            conn.execute(sa.insert(model.Commit.__table__), rows)
+
+        pulls = []
+        assocs = []
+        for number in range(1, n_pulls + 1):
+            pulls.append(
+                dict(
+                    number=number,
+                    url="",
+                    html_url="",
+                    state="open" if number % 10 == 0 else "closed",
+                    title=f"PR {number}",
+                    body="",
+                    created_at=start + datetime.timedelta(hours=number),
+                    updated_at=start + datetime.timedelta(hours=rng.randrange(10**5)),
+                    user_id=rng.randrange(50),
+                    head_label="",
+                    head_ref="",
+                    head_sha=f"{rng.randrange(n_commits):040x}",
+                    head_user_id=0,
+                    head_repo_full_name="",
+                    head_repo_html_url="",
+                    head_repo_clone_url="",
+                    base_label="",
+                    base_ref="",
+                    base_sha="",
+                    base_user_id=0,
+                    base_repo_full_name="",
+                    base_repo_html_url="",
+                    base_repo_clone_url="",
+                    mergeable=True,
+                )
+            )
+            for order, sha in enumerate(
+                rng.sample(range(n_commits), k=rng.randrange(1, 15))
+            ):
+                assocs.append(
+                    dict(
+                        pull_request_number=number,
+                        commit_sha=f"{sha:040x}",
+                        order=order,
+                    )
+                )
+        for rows in chunked(pulls):
+            conn.execute(sa.insert(model.PullRequest.__table__), rows)
+        for rows in chunked(assocs):
+            conn.execute(sa.insert(model.PrCommitAssociation.__table__), rows)
+
+        pipeline_rows = []
+        job_rows = []
+        for pipeline_id in range(1, n_commits * pipelines + 1):
+            sha = f"{rng.randrange(n_commits):040x}"
+            created_at = start + datetime.timedelta(minutes=pipeline_id)
+            pipeline_rows.append(
+                dict(
+                    id=pipeline_id,
+                    iid=pipeline_id,
+                    project_id=1,
+                    sha=sha,
+                    source_sha=sha,
+                    ref="main",
+                    status=rng.choice(["success", "failed", "running"]),
+                    source="trigger",
+                    created_at=created_at,
+                    updated_at=created_at,
+                    web_url="",
+                    variables={"SOURCE_SHA": sha},
+                    refreshed_at=created_at,
+                )
+            )
+            for j in range(jobs):
+                job_rows.append(
+                    dict(
+                        id=pipeline_id * jobs + j,
+                        status="success",
+                        stage=rng.choice(["build", "test", "report"]),
+                        name=f"job {j}",
+                        ref="main",
+                        allow_failure=False,
+                        created_at=created_at,
+                        web_url="",
+                        pipeline_id=pipeline_id,
+                    )
+                )
+        for rows in chunked(pipeline_rows):
+            conn.execute(sa.insert(model.Pipeline.__table__), rows)
+        for rows in chunked(job_rows):
+            conn.execute(sa.insert(model.Job.__table__), rows)
+
+
+def queries(n_commits: int) -> dict[str, sa.Executable]:
+    sha = f"{(n_commits // 2):040x}"
+    shas = [f"{i:040x}" for i in range(n_commits // 2, n_commits // 2 + 20)]
+    return {
+        "Commit.latest_pipeline": sa.select(model.Pipeline)
+        .filter_by(source_sha=sha)
+        .order_by(model.Pipeline.created_at.desc())
+        .limit(1),
+        "timeline page": sa.select(model.Commit)
+        .filter(model.Commit.order >= 0)
+        .order_by(model.Commit.order.desc())
+        .offset(200)
+        .limit(20),
+        "timeline count": sa.select(sa.func.count("*")).where(model.Commit.order >= 0),
+        "timeline pipelines": sa.select(model.Pipeline).where(
+            model.Pipeline.source_sha.in_(shas)
+        ),
+        "open pulls page": sa.select(model.PullRequest)
+        .filter_by(state="open")
+        .order_by(model.PullRequest.updated_at.desc())
+        .limit(20),
+        "open pulls count": sa.select(sa.func.count("*")).where(
+            model.PullRequest.state == "open"
+        ),
+        "pipeline jobs": sa.select(model.Job).where(model.Job.pipeline_id == 1234),
+        "pull commits": sa.select(model.PrCommitAssociation)
+        .where(model.PrCommitAssociation.pull_request_number == 500)
+        .order_by(model.PrCommitAssociation.order.desc()),
+    }
+
+
+def explain(engine: Engine, stmt: sa.Executable) -> str:
+    sql = str(stmt.compile(engine, compile_kwargs={"literal_binds": True}))
+    prefix = "EXPLAIN QUERY PLAN" if engine.dialect.name == "sqlite" else "EXPLAIN"
+    with engine.connect() as conn:
+        rows = conn.execute(sa.text(f"{prefix} {sql}")).all()
+    return "\n".join(" ".join(str(c) for c in row) for row in rows)
+
+
+def measure(fn: Callable[[], object], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def run(engine: Engine, n_commits: int, repeat: int) -> dict[str, float]:
+    results = {}
+    for name, stmt in queries(n_commits).items():
+        with engine.connect() as conn:
+            latency = measure(lambda: conn.execute(stmt).all(), repeat)
+        results[name] = latency
+        click.secho(f"--- {name}: {latency * 1e3:.3f} ms", bold=True)
+        click.echo(explain(engine, stmt))
+    return results
+
+
+@click.command()
+@click.option("--url", default="sqlite://", help="Database to seed (will be wiped)")
+@click.option("--commits", default=50000)
+@click.option("--pulls", default=5000)
+@click.option("--pipelines", default=2, help="Pipelines per commit")
+@click.option("--jobs", default=10, help="Jobs per pipeline")
+@click.option("--repeat", default=20)
+def main(url: str, commits: int, pulls: int, pipelines: int, jobs: int, repeat: int):
+    engine = sa.create_engine(url)
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+
+    for index in SECONDARY_INDEXES:
+        index.drop(engine)
+
+    click.echo(f"Seeding {url}")
+    seed(engine, commits, pulls, pipelines, jobs)
+
+    with engine.begin() as conn:
+        conn.execute(sa.text("ANALYZE"))
+
+    click.secho("\n=== Without secondary indexes\n", fg="yellow")
+    before = run(engine, commits, repeat)
+
+    for index in SECONDARY_INDEXES:
+        index.create(engine)
+    with engine.begin() as conn:
+        conn.execute(sa.text("ANALYZE"))
+
+    click.secho("\n=== With secondary indexes\n", fg="yellow")
+    after = run(engine, commits, repeat)
+
+    click.secho("\n=== Summary\n", fg="yellow")
+    for name in before:
+        click.echo(
+            f"{name:<25} {before[name] * 1e3:>9.3f} ms -> {after[name] * 1e3:>9.3f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
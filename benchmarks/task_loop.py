@@ -0,0 +1,176 @@
+"""
+Replay a burst of webhook-like async tasks on a pool of worker threads, like
+`celery worker --pool threads`, and report task latency and throughput. Each
+task makes a few API calls against a local HTTPS server. Compares running
+every task with `asyncio.run` and a fresh client session, as the tasks used to,
+with the persistent per-thread loop and pooled session of `apogee.util.coroutine`.
+
+    python benchmarks/task_loop.py --events 500 --threads 4
+    python benchmarks/task_loop.py --latency 50 --requests 5 --no-tls
+"""
+
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import ipaddress
+import json
+import ssl
+import statistics
+import tempfile
+import threading
+import time
+from typing import Callable
+
+import click
+from aiohttp import web
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from apogee.http import client_session, close_client_session
+from apogee.util import coroutine
+
+Task = Callable[[int], int]
+
+
+def self_signed(directory: str) -> tuple[str, str]:
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+            ),
+            critical=False,
+        )
+        .sign(key, hashes.SHA256())
+    )
+    cert_file = f"{directory}/cert.pem"
+    key_file = f"{directory}/key.pem"
+    with open(cert_file, "wb") as fh:
+        fh.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_file, "wb") as fh:
+        fh.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    return cert_file, key_file
+
+
+def serve(latency: float, server_ssl: ssl.SSLContext | None) -> int:
+    """Start a fake API in a background thread, returns its port"""
+    body = json.dumps({"commits": [{"sha": "0" * 40}] * 50}).encode()
+
+    async def handler(request: web.Request) -> web.Response:
+        await asyncio.sleep(latency)
+        return web.Response(body=body, content_type="application/json")
+
+    started = threading.Event()
+    port = 0
+
+    def run() -> None:
+        nonlocal port
+        loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_get("/{tail:.*}", handler)
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0, ssl_context=server_ssl)
+        loop.run_until_complete(site.start())
+        port = site._server.sockets[0].getsockname()[1]  # type: ignore
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return port
+
+
+def per_call(fn):
+    # what `apogee.util.coroutine` used to do
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        async def run():
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                await close_client_session()
+
+        return asyncio.run(run())
+
+    return wrapper
+
+
+def make_task(url: str, n_requests: int, client_ssl: ssl.SSLContext | bool):
+    async def task(event: int) -> int:
+        size = 0
+        for i in range(n_requests):
+            async with client_session().get(
+                f"{url}/repos/acts/compare/{event}/{i}", ssl=client_ssl
+            ) as resp:
+                resp.raise_for_status()
+                size += len(await resp.read())
+        return size
+
+    return task
+
+
+def replay(task: Task, events: int, threads: int) -> tuple[list[float], float]:
+    def timed(event: int) -> float:
+        start = time.perf_counter()
+        task(event)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        latencies = list(executor.map(timed, range(events)))
+    return latencies, time.perf_counter() - start
+
+
+@click.command()
+@click.option("--events", default=500, help="Number of webhook tasks to replay")
+@click.option("--threads", default=4, help="Worker threads")
+@click.option("--requests", "n_requests", default=3, help="API calls per task")
+@click.option("--latency", default=20.0, help="Server response time in ms")
+@click.option("--tls/--no-tls", default=True)
+def main(events: int, threads: int, n_requests: int, latency: float, tls: bool):
+    with tempfile.TemporaryDirectory() as directory:
+        server_ssl = None
+        client_ssl: ssl.SSLContext | bool = True
+        if tls:
+            cert_file, key_file = self_signed(directory)
+            server_ssl = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            server_ssl.load_cert_chain(cert_file, key_file)
+            client_ssl = ssl.create_default_context(cafile=cert_file)
+
+        port = serve(latency / 1e3, server_ssl)
+        url = f"{'https' if tls else 'http'}://127.0.0.1:{port}"
+        task = make_task(url, n_requests, client_ssl)
+
+        for name, wrap in (("asyncio.run", per_call), ("persistent", coroutine)):
+            latencies, duration = replay(wrap(task), events, threads)
+            latencies.sort()
+            p95 = latencies[int(0.95 * (len(latencies) - 1))]
+            click.echo(
+                f"{name:<12} mean {statistics.mean(latencies) * 1e3:>7.1f} ms, "
+                f"p50 {statistics.median(latencies) * 1e3:>7.1f} ms, "
+                f"p95 {p95 * 1e3:>7.1f} ms, "
+                f"{events / duration:>7.1f} tasks/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
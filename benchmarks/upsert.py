@@ -0,0 +1,139 @@
+"""
+Count the SQL statements and time needed to write a pipeline with many jobs,
+once with the previous `session.merge` per object approach and once with the
+bulk upsert in `apogee.model.upsert`.
+
+    python benchmarks/upsert.py --jobs 300
+    python benchmarks/upsert.py --url postgresql://localhost/apogee_bench
+"""
+
+import datetime
+import time
+from typing import Callable
+
+import click
+import flask
+from sqlalchemy import event
+
+from apogee.model import db as model
+from apogee.model.db import db
+from apogee.model.gitlab import Job, Pipeline
+from apogee.model.upsert import upsert_pipelines
+
+SHA = "0" * 40
+
+
+def api_pipeline(n_jobs: int, status: str) -> Pipeline:
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    return Pipeline(
+        id=1,
+        iid=1,
+        project_id=1,
+        sha=SHA,
+        ref="main",
+        status=status,
+        source="trigger",
+        created_at=now,
+        updated_at=now,
+        web_url="",
+        variables={"SOURCE_SHA": SHA},
+        jobs=[
+            Job(
+                id=i,
+                status=status,
+                stage="test",
+                name=f"job {i}",
+                ref="main",
+                allow_failure=False,
+                created_at=now,
+                started_at=now,
+                finished_at=None,
+                web_url="",
+            )
+            for i in range(n_jobs)
+        ],
+    )
+
+
+def write_merge(pipeline: Pipeline) -> None:
+    # what the webhook and reload handlers used to do
+    db_pipeline = model.Pipeline.from_api(pipeline)
+    db_pipeline.refreshed_at = datetime.datetime.utcnow()
+    db_pipeline = db.session.merge(db_pipeline)
+    db_pipeline.jobs = []
+
+    for job in pipeline.jobs:
+        db_job = model.Job.from_api(job)
+        db_job.pipeline_id = db_pipeline.id
+        db.session.merge(db_job)
+
+    model.update_latest_pipelines([SHA])
+    db.session.commit()
+
+
+def write_upsert(pipeline: Pipeline) -> None:
+    upsert_pipelines([pipeline], refreshed_at=datetime.datetime.utcnow())
+    db.session.commit()
+
+
+def reset() -> None:
+    db.drop_all()
+    db.create_all()
+    now = datetime.datetime.now()
+    db.session.add(
+        model.Commit(
+            sha=SHA,
+            url="",
+            html_url="",
+            commit_author="",
+            commit_committer="",
+            message="",
+            committed_date=now,
+            authored_date=now,
+            order=0,
+        )
+    )
+    db.session.commit()
+
+
+def measure(write: Callable[[Pipeline], None], n_jobs: int) -> list[tuple[int, float]]:
+    statements = 0
+
+    def count(*args, **kwargs):
+        nonlocal statements
+        statements += 1
+
+    reset()
+    event.listen(db.engine, "before_cursor_execute", count)
+    results = []
+    try:
+        # first event creates the pipeline, later ones update it
+        for status in ("created", "running", "success"):
+            statements = 0
+            start = time.perf_counter()
+            write(api_pipeline(n_jobs, status))
+            results.append((statements, time.perf_counter() - start))
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count)
+    return results
+
+
+@click.command()
+@click.option("--url", default="sqlite://", help="Database to use (will be wiped)")
+@click.option("--jobs", default=300)
+def main(url: str, jobs: int):
+    app = flask.Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = url
+    db.init_app(app)
+
+    with app.app_context():
+        for name, write in (("merge", write_merge), ("upsert", write_upsert)):
+            for i, (statements, duration) in enumerate(measure(write, jobs)):
+                click.echo(
+                    f"{name:<7} event {i}: {statements:>5} statements, "
+                    f"{duration * 1e3:>8.1f} ms"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Add indexes for timeline, pull list and webhook lookups
+
+Revision ID: 3f9c1d2b7a41
+Revises: 76d7ab19c1bf
+Create Date: 2026-10-17 09:12:03.418522
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "3f9c1d2b7a41"
+down_revision = "76d7ab19c1bf"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("commit", schema=None) as batch_op:
+        batch_op.create_index(
+            "ix_commit_order_main",
+            ["order"],
+            unique=False,
+            postgresql_where=sa.column("order") >= 0,
+            sqlite_where=sa.column("order") >= 0,
+        )
+
+    with op.batch_alter_table("pipeline", schema=None) as batch_op:
+        batch_op.create_index(
+            "ix_pipeline_source_sha_created_at",
+            ["source_sha", "created_at"],
+            unique=False,
+        )
+
+    with op.batch_alter_table("job", schema=None) as batch_op:
+        batch_op.create_index(
+            batch_op.f("ix_job_pipeline_id"), ["pipeline_id"], unique=False
+        )
+
+    with op.batch_alter_table("pull_request", schema=None) as batch_op:
+        batch_op.create_index(
+            "ix_pull_request_state_updated_at",
+            ["state", "updated_at"],
+            unique=False,
+        )
+
+    with op.batch_alter_table("pr_commit_association", schema=None) as batch_op:
+        batch_op.create_index(
+            "ix_pr_commit_association_pull_request_number_order",
+            ["pull_request_number", "order"],
+            unique=False,
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("pr_commit_association", schema=None) as batch_op:
+        batch_op.drop_index("ix_pr_commit_association_pull_request_number_order")
+
+    with op.batch_alter_table("pull_request", schema=None) as batch_op:
+        batch_op.drop_index("ix_pull_request_state_updated_at")
+
+    with op.batch_alter_table("job", schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f("ix_job_pipeline_id"))
+
+    with op.batch_alter_table("pipeline", schema=None) as batch_op:
+        batch_op.drop_index("ix_pipeline_source_sha_created_at")
+
+    with op.batch_alter_table("commit", schema=None) as batch_op:
+        batch_op.drop_index("ix_commit_order_main")
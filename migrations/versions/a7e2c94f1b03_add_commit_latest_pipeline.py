@@ -0,0 +1,46 @@
+"""Add denormalized latest pipeline pointer to commit
+
+Revision ID: a7e2c94f1b03
+Revises: 3f9c1d2b7a41
+Create Date: 2026-10-17 10:02:45.913207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a7e2c94f1b03"
+down_revision = "3f9c1d2b7a41"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("commit", schema=None) as batch_op:
+        batch_op.add_column(
+            sa.Column("latest_pipeline_id", sa.Integer(), nullable=True)
+        )
+        batch_op.create_foreign_key(
+            batch_op.f("fk_commit_latest_pipeline_id_pipeline"),
+            "pipeline",
+            ["latest_pipeline_id"],
+            ["id"],
+            use_alter=True,
+        )
+
+    # backfill, same as `flask backfill-latest-pipelines`
+    op.execute(
+        'UPDATE "commit" SET latest_pipeline_id = ('
+        "SELECT pipeline.id FROM pipeline "
+        'WHERE pipeline.source_sha = "commit".sha '
+        "ORDER BY pipeline.created_at DESC, pipeline.id DESC LIMIT 1)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table("commit", schema=None) as batch_op:
+        batch_op.drop_constraint(
+            batch_op.f("fk_commit_latest_pipeline_id_pipeline"), type_="foreignkey"
+        )
+        batch_op.drop_column("latest_pipeline_id")
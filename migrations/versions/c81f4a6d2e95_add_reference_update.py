@@ -0,0 +1,44 @@
+"""Add reference update status table
+
+Revision ID: c81f4a6d2e95
+Revises: a7e2c94f1b03
+Create Date: 2026-10-17 11:24:37.602114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "c81f4a6d2e95"
+down_revision = "a7e2c94f1b03"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "reference_update",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("pipeline_id", sa.Integer(), nullable=False),
+        sa.Column("job_id", sa.Integer(), nullable=False),
+        sa.Column("job_name", sa.String(), nullable=False),
+        sa.Column("qtest", sa.String(), nullable=False),
+        sa.Column("version", sa.String(), nullable=False),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("trace", sa.String(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["pipeline_id"],
+            ["pipeline.id"],
+            name=op.f("fk_reference_update_pipeline_id_pipeline"),
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_reference_update")),
+        sa.UniqueConstraint(
+            "pipeline_id", "job_id", name=op.f("uq_reference_update_pipeline_id")
+        ),
+    )
+
+
+def downgrade():
+    op.drop_table("reference_update")
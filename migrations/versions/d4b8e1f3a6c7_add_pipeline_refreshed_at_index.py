@@ -0,0 +1,27 @@
+"""Add pipeline refreshed_at index
+
+Revision ID: d4b8e1f3a6c7
+Revises: c81f4a6d2e95
+Create Date: 2026-10-17 14:03:51.229406
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "d4b8e1f3a6c7"
+down_revision = "c81f4a6d2e95"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("pipeline", schema=None) as batch_op:
+        batch_op.create_index(
+            "ix_pipeline_refreshed_at", ["refreshed_at"], unique=False
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("pipeline", schema=None) as batch_op:
+        batch_op.drop_index("ix_pipeline_refreshed_at")
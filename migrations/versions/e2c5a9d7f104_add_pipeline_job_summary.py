@@ -0,0 +1,29 @@
+"""Add job summary to pipeline
+
+Existing pipelines are left without a summary, run `flask backfill-job-summaries`
+after upgrading to fill it in.
+
+Revision ID: e2c5a9d7f104
+Revises: d4b8e1f3a6c7
+Create Date: 2026-10-17 15:21:08.774130
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e2c5a9d7f104"
+down_revision = "d4b8e1f3a6c7"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("pipeline", schema=None) as batch_op:
+        batch_op.add_column(sa.Column("job_summary", sa.JSON(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("pipeline", schema=None) as batch_op:
+        batch_op.drop_column("job_summary")
@@ -0,0 +1,282 @@
+from dataclasses import dataclass
+import re
+import struct
+import tempfile
+from typing import AsyncIterator, Dict, IO, Mapping, Optional
+import zipfile
+import zlib
+
+import aiohttp
+
+CHUNK_SIZE = 1024 * 1024
+
+_EOCD = struct.Struct("<4sHHHHIIH")
+_ZIP64_LOCATOR = struct.Struct("<4sIQI")
+_ZIP64_EOCD = struct.Struct("<4sQHHIIQQQQ")
+_CENTRAL_HEADER = struct.Struct("<4sHHHHHHIIIHHHHHII")
+_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+
+# EOCD plus the largest possible comment
+_TAIL_SIZE = _EOCD.size + 0xFFFF
+
+
+class ZipError(Exception):
+    pass
+
+
+@dataclass
+class ZipMember:
+    name: str
+    header_offset: int
+    compressed_size: int
+    file_size: int
+    crc32: int
+    method: int
+
+
+def _parse_zip64_extra(
+    extra: bytes, file_size: int, compressed_size: int, header_offset: int
+) -> tuple[int, int, int]:
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack_from("<HH", extra, pos)
+        pos += 4
+        if tag == 0x0001:
+            values = iter(struct.unpack_from(f"<{size // 8}Q", extra, pos))
+            # only the fields that overflowed are present, in this order
+            if file_size == 0xFFFFFFFF:
+                file_size = next(values)
+            if compressed_size == 0xFFFFFFFF:
+                compressed_size = next(values)
+            if header_offset == 0xFFFFFFFF:
+                header_offset = next(values)
+            break
+        pos += size
+    return file_size, compressed_size, header_offset
+
+
+def _parse_central_directory(data: bytes, count: int) -> Dict[str, ZipMember]:
+    members = {}
+    pos = 0
+    for _ in range(count):
+        (
+            signature,
+            _,
+            _,
+            flags,
+            method,
+            _,
+            _,
+            crc32,
+            compressed_size,
+            file_size,
+            name_length,
+            extra_length,
+            comment_length,
+            _,
+            _,
+            _,
+            header_offset,
+        ) = _CENTRAL_HEADER.unpack_from(data, pos)
+        if signature != b"PK\x01\x02":
+            raise ZipError("Bad central directory entry")
+        pos += _CENTRAL_HEADER.size
+
+        raw_name = data[pos : pos + name_length]
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        pos += name_length
+
+        file_size, compressed_size, header_offset = _parse_zip64_extra(
+            data[pos : pos + extra_length], file_size, compressed_size, header_offset
+        )
+        pos += extra_length + comment_length
+
+        members[name] = ZipMember(
+            name=name,
+            header_offset=header_offset,
+            compressed_size=compressed_size,
+            file_size=file_size,
+            crc32=crc32,
+            method=method,
+        )
+    return members
+
+
+class RemoteZip:
+    """
+    Read members of a zip archive served over HTTP, without downloading all of
+    it. The central directory is located from the end of the file and the
+    member data is requested by byte range. If the server does not support
+    range requests, the archive is downloaded once to a temporary file.
+
+        async with RemoteZip(session, url) as archive:
+            async for chunk in archive.iter_member("run/file.root"):
+                ...
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        headers: Optional[Mapping[str, str]] = None,
+    ):
+        self.session = session
+        self.url = url
+        self.headers = dict(headers or {})
+        self.members: Dict[str, ZipMember] = {}
+        self.bytes_downloaded = 0
+        self._local: Optional[IO[bytes]] = None
+
+    async def __aenter__(self) -> "RemoteZip":
+        await self.load()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._local is not None:
+            self._local.close()
+            self._local = None
+
+    @property
+    def is_remote(self) -> bool:
+        return self._local is None
+
+    async def _get_range(self, start: int, end: int) -> bytes:
+        async with self.session.get(
+            self.url, headers={**self.headers, "range": f"bytes={start}-{end}"}
+        ) as resp:
+            resp.raise_for_status()
+            if resp.status != 206:
+                raise ZipError("Server ignored range request")
+            data = await resp.read()
+            self.bytes_downloaded += len(data)
+            return data
+
+    async def load(self) -> None:
+        async with self.session.get(
+            self.url, headers={**self.headers, "range": f"bytes=-{_TAIL_SIZE}"}
+        ) as resp:
+            resp.raise_for_status()
+            # artifacts redirect to object storage, don't go through that again
+            self.url = str(resp.url)
+            if resp.status != 206:
+                await self._download(resp)
+                return
+            tail = await resp.read()
+            self.bytes_downloaded += len(tail)
+            m = re.match(
+                r"bytes (\d+)-\d+/(\d+)", resp.headers.get("content-range", "")
+            )
+            if m is None:
+                raise ZipError("Missing content range")
+            tail_start = int(m.group(1))
+
+        idx = tail.rfind(b"PK\x05\x06")
+        if idx == -1:
+            raise ZipError("End of central directory not found")
+
+        (_, _, _, _, count, cd_size, cd_offset, _) = _EOCD.unpack_from(tail, idx)
+
+        locator_idx = idx - _ZIP64_LOCATOR.size
+        if locator_idx >= 0 and tail[locator_idx : locator_idx + 4] == b"PK\x06\x07":
+            _, _, zip64_offset, _ = _ZIP64_LOCATOR.unpack_from(tail, locator_idx)
+            if zip64_offset >= tail_start:
+                record = tail[zip64_offset - tail_start :]
+            else:
+                record = await self._get_range(
+                    zip64_offset, zip64_offset + _ZIP64_EOCD.size - 1
+                )
+            (signature, _, _, _, _, _, _, count, cd_size, cd_offset) = (
+                _ZIP64_EOCD.unpack_from(record)
+            )
+            if signature != b"PK\x06\x06":
+                raise ZipError("Bad zip64 end of central directory")
+
+        if cd_offset >= tail_start:
+            directory = tail[cd_offset - tail_start : cd_offset - tail_start + cd_size]
+        else:
+            directory = await self._get_range(cd_offset, cd_offset + cd_size - 1)
+
+        self.members = _parse_central_directory(directory, count)
+
+    async def _download(self, resp: aiohttp.ClientResponse) -> None:
+        self._local = tempfile.TemporaryFile()
+        async for data in resp.content.iter_chunked(CHUNK_SIZE):
+            self._local.write(data)
+        self.bytes_downloaded += self._local.tell()
+        self._local.seek(0)
+
+        with zipfile.ZipFile(self._local) as zf:
+            for info in zf.infolist():
+                self.members[info.filename] = ZipMember(
+                    name=info.filename,
+                    header_offset=info.header_offset,
+                    compressed_size=info.compress_size,
+                    file_size=info.file_size,
+                    crc32=info.CRC,
+                    method=info.compress_type,
+                )
+
+    def exists(self, name: str) -> bool:
+        return name in self.members or any(
+            m.startswith(name.rstrip("/") + "/") for m in self.members
+        )
+
+    async def iter_member(
+        self, name: str, chunk_size: int = CHUNK_SIZE
+    ) -> AsyncIterator[bytes]:
+        """Decompressed content of a member, checked against its CRC32"""
+        member = self.members[name]
+
+        if self._local is not None:
+            with zipfile.ZipFile(self._local) as zf, zf.open(name) as fh:
+                while chunk := fh.read(chunk_size):
+                    yield chunk
+            return
+
+        if member.method == zipfile.ZIP_STORED:
+            decompressor = None
+        elif member.method == zipfile.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        else:
+            raise ZipError(f"Unsupported compression method {member.method}")
+
+        header = await self._get_range(
+            member.header_offset, member.header_offset + _LOCAL_HEADER.size - 1
+        )
+        fields = _LOCAL_HEADER.unpack(header)
+        if fields[0] != b"PK\x03\x04":
+            raise ZipError(f"Bad local header for {name}")
+        data_start = member.header_offset + _LOCAL_HEADER.size + fields[9] + fields[10]
+
+        crc = 0
+        size = 0
+        if member.compressed_size > 0:
+            async with self.session.get(
+                self.url,
+                headers={
+                    **self.headers,
+                    "range": f"bytes={data_start}-"
+                    f"{data_start + member.compressed_size - 1}",
+                },
+            ) as resp:
+                resp.raise_for_status()
+                if resp.status != 206:
+                    raise ZipError("Server ignored range request")
+                async for data in resp.content.iter_chunked(chunk_size):
+                    self.bytes_downloaded += len(data)
+                    if decompressor is not None:
+                        data = decompressor.decompress(data)
+                    if data:
+                        crc = zlib.crc32(data, crc)
+                        size += len(data)
+                        yield data
+                if decompressor is not None and (rest := decompressor.flush()):
+                    crc = zlib.crc32(rest, crc)
+                    size += len(rest)
+                    yield rest
+
+        if size != member.file_size or crc != member.crc32:
+            raise ZipError(f"Size or checksum mismatch for {name}")
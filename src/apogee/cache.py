@@ -7,6 +7,8 @@ from apogee import config
 from diskcache import Cache
 
 cache = Cache(config.CACHE_DIR)
+# for evicting by tag, e.g. rendered fragments of a pipeline
+cache.create_tag_index()
 
 
 def memoize(key=None, expire=None) -> Callable:
@@ -1,44 +1,59 @@
-import asyncio
 import re
 import aiohttp
 
 from gidgetlab.abc import GitLabAPI
 import click
 from sshfs import SSHFileSystem
-from webdav4.fsspec import WebdavFileSystem
-from apogee import config
+import apogee.gitlab
+import apogee.http
 
 from apogee.model.db import db
+from apogee.model import db as model
 from apogee.model.gitlab import Pipeline
 from apogee.util import (
+    coroutine,
+    eos_filesystem,
     execute_reference_update,
     get_pipeline_references,
     parse_pipeline_url,
+    run_reference_updates,
 )
 from apogee.web.util import with_gitlab
 
 
+@coroutine
 @with_gitlab
 async def update_references(
     session: aiohttp.ClientSession, gl: GitLabAPI, pipeline_url: str, dry_run: bool
 ):
     owner, repo, pipeline_id = parse_pipeline_url(pipeline_url)
 
-    eos = WebdavFileSystem(
-        "https://cernbox.cern.ch/cernbox/webdav/",
-        auth=(config.EOS_USER_NAME, config.EOS_USER_PWD),
-    )
+    eos = eos_filesystem()
 
-    assert eos.exists(config.EOS_BASE_PATH), f"{config.EOS_BASE_PATH} does not exist"
+    refs = await get_pipeline_references(gl, owner, repo, pipeline_id)
 
-    for job, qtest, version in await get_pipeline_references(
-        gl, owner, repo, pipeline_id
-    ):
-        trace = await execute_reference_update(
+    async def update(job, qtest, version):
+        return await execute_reference_update(
             session, gl, eos, owner, repo, job, qtest, version, dry_run
         )
 
-        print(trace)
+    failed = False
+    for (job, _, _), trace in zip(refs, await run_reference_updates(refs, update)):
+        if isinstance(trace, BaseException):
+            print(f"Job #{job.id} {job.name} failed: {trace!r}")
+            failed = True
+        else:
+            print(trace)
+
+    if failed:
+        raise SystemExit(1)
+
+
+@coroutine
+@with_gitlab
+async def reload_pipelines(gl: GitLabAPI, full: bool):
+    n_listed, n_updated = await apogee.gitlab.reload_pipelines(gl, full=full)
+    print(f"Updated {n_updated} of {n_listed} changed pipelines")
 
 
 def add_cli(app):
@@ -63,8 +78,52 @@ def add_cli(app):
                 db.session.add(model.Patch(url=patch, commit=c, order=i))
         db.session.commit()
 
+    @app.cli.command("backfill-latest-pipelines")
+    def _backfill_latest_pipelines():
+        model.update_latest_pipelines()
+        db.session.commit()
+
+    @app.cli.command("backfill-job-summaries")
+    def _backfill_job_summaries():
+        model.update_job_summaries()
+        db.session.commit()
+
+    @app.cli.command("check-latest-pipelines")
+    @click.option("--fix", is_flag=True, help="Update stale commits")
+    def _check_latest_pipelines(fix: bool):
+        stale = model.find_stale_latest_pipelines()
+        for sha, stored, expected in stale:
+            print(f"{sha}: latest pipeline is {stored}, expected {expected}")
+
+        if len(stale) == 0:
+            print("All commits point at their latest pipeline")
+            return
+
+        if fix:
+            model.update_latest_pipelines([sha for sha, _, _ in stale])
+            db.session.commit()
+            print(f"Updated {len(stale)} commits")
+        else:
+            raise SystemExit(1)
+
+    @app.cli.command("reload-pipelines")
+    @click.option("--full", is_flag=True, help="Ignore the last refresh time")
+    def _reload_pipelines(full: bool):
+        reload_pipelines(full=full)
+
+    @app.cli.command("http-cache-stats")
+    @click.option("--reset", is_flag=True, help="Reset the counters afterwards")
+    def _http_cache_stats(reset: bool):
+        stats = apogee.http.cache_stats()
+        total = stats["hits"] + stats["misses"]
+        ratio = stats["hits"] / total if total > 0 else 0
+        print(f"{stats['hits']} not modified, {stats['misses']} fetched ({ratio:.0%})")
+        print(f"{stats['bytes_saved'] / 1e6:.1f} MB not downloaded")
+        if reset:
+            apogee.http.reset_cache_stats()
+
     @app.cli.command("update-references")
     @click.argument("pipeline_url")
     @click.option("--dry-run", is_flag=True)
     def _update_references(pipeline_url: str, dry_run: bool):
-        asyncio.run(update_references(pipeline_url=pipeline_url, dry_run=dry_run))
+        update_references(pipeline_url=pipeline_url, dry_run=dry_run)
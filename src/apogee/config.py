@@ -8,8 +8,23 @@ GITLAB_URL = "https://gitlab.cern.ch"
 GITLAB_PROJECT = "acts/acts-athena-ci"
 GITLAB_PROJECT_ID = 153873
 GITLAB_PIPELINES_WINDOW_DAYS = int(os.environ.get("GITLAB_PIPELINES_WINDOW_DAYS", 4))
+GITLAB_PIPELINES_REFRESH_OVERLAP_MINUTES = int(
+    os.environ.get("GITLAB_PIPELINES_REFRESH_OVERLAP_MINUTES", 10)
+)
 GITLAB_CONCURRENCY_LIMIT = 50
 
+HTTP_CONNECTION_LIMIT = int(os.environ.get("HTTP_CONNECTION_LIMIT", 100))
+HTTP_CONNECTION_LIMIT_PER_HOST = int(
+    os.environ.get("HTTP_CONNECTION_LIMIT_PER_HOST", GITLAB_CONCURRENCY_LIMIT)
+)
+HTTP_DNS_CACHE_TTL = int(os.environ.get("HTTP_DNS_CACHE_TTL", 300))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 30))
+HTTP_CACHE_EXPIRE_DAYS = int(os.environ.get("HTTP_CACHE_EXPIRE_DAYS", 7))
+
+# how much of the end of a job log to scan before falling back to all of it
+TRACE_TAIL_BYTES = int(os.environ.get("TRACE_TAIL_BYTES", 512 * 1024))
+TRACE_CACHE_EXPIRE_DAYS = int(os.environ.get("TRACE_CACHE_EXPIRE_DAYS", 30))
+
 GITLAB_CANARY_PROJECT_ID = 66770
 GITLAB_CANARY_PROJECT = "acts/athena"
 GITLAB_CANARY_BRANCH = "canary"
@@ -28,6 +43,11 @@ CERN_AUTH_CLIENT_SECRET = os.environ["CERN_AUTH_CLIENT_SECRET"]
 GITHUB_APP_ID = os.environ["GITHUB_APP_ID"]
 GITHUB_APP_PRIVATE_KEY = os.environ["GITHUB_APP_PRIVATE_KEY"]
 
+# installation tokens are renewed in the background this long before they expire
+GITHUB_TOKEN_REFRESH_AHEAD_SECONDS = int(
+    os.environ.get("GITHUB_TOKEN_REFRESH_AHEAD_SECONDS", 10 * 60)
+)
+
 GITHUB_CLIENT_SECRET = os.environ["GITHUB_CLIENT_SECRET"]
 GITHUB_CLIENT_ID = os.environ["GITHUB_CLIENT_ID"]
 
@@ -36,8 +56,37 @@ EOS_BASE_PATH = os.environ["EOS_BASE_PATH"]
 EOS_USER_NAME = os.environ["EOS_USER_NAME"]
 EOS_USER_PWD = os.environ["EOS_USER_PWD"]
 
+REFERENCE_UPDATE_CONCURRENCY = int(os.environ.get("REFERENCE_UPDATE_CONCURRENCY", 4))
+# an update without progress for this long is taken to be lost with its worker
+REFERENCE_UPDATE_STALE_MINUTES = int(
+    os.environ.get("REFERENCE_UPDATE_STALE_MINUTES", 30)
+)
+
+# read uploaded reference files back to compare their checksum
+REFERENCE_UPLOAD_VERIFY_CHECKSUM = (
+    os.environ.get("REFERENCE_UPLOAD_VERIFY_CHECKSUM", "1") == "1"
+)
+
 SESSION_REDIS_URL = os.environ.get("SESSION_REDIS_URL")
 
+REDIS_URL = os.environ.get("REDIS_URL", os.environ.get("CELERY_BROKER_URL"))
+
+# job webhooks are buffered in redis and written in batches, at the latest
+# after the interval or once this many distinct jobs are waiting
+JOB_WEBHOOK_FLUSH_INTERVAL_MS = int(os.environ.get("JOB_WEBHOOK_FLUSH_INTERVAL_MS", 500))
+JOB_WEBHOOK_BATCH_SIZE = int(os.environ.get("JOB_WEBHOOK_BATCH_SIZE", 200))
+
+# a webhook with the same status as the last one for the object is dropped
+WEBHOOK_DEDUPLICATION_SECONDS = int(
+    os.environ.get("WEBHOOK_DEDUPLICATION_SECONDS", 60 * 60)
+)
+WEBHOOK_COMPRESSION_MIN_BYTES = int(
+    os.environ.get("WEBHOOK_COMPRESSION_MIN_BYTES", 16 * 1024)
+)
+
+# open pages ask this often which pipelines the webhooks changed
+PIPELINE_EVENTS_POLL_SECONDS = int(os.environ.get("PIPELINE_EVENTS_POLL_SECONDS", 5))
+
 
 OBJECT_COUNTS_CACHE_KEY_PREFIX = "object_counts_"
 OBJECT_COUNTS_CACHE_EXPIRATION = 60 * 60 * 24 * 7  # 7 days
\ No newline at end of file
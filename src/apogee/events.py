@@ -0,0 +1,69 @@
+import logging
+from typing import Iterable, Optional
+
+import redis
+
+from apogee.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_EVENTS_KEY = "apogee:events:pipelines"
+
+# pages poll every few seconds, so only the latest changes are needed
+_MAX_EVENTS = 1000
+
+
+def publish_pipeline_changes(pipeline_ids: Iterable[int]) -> None:
+    """
+    Record that these pipelines changed, after the change has been committed.
+    Without redis, there are no live updates.
+    """
+    r = get_redis()
+    ids = sorted(set(pipeline_ids))
+    if r is None or len(ids) == 0:
+        return
+    try:
+        r.xadd(
+            PIPELINE_EVENTS_KEY,
+            {"ids": ",".join(str(pipeline_id) for pipeline_id in ids)},
+            maxlen=_MAX_EVENTS,
+            approximate=True,
+        )
+    except redis.RedisError:
+        # the data is written, open pages just don't see it until they reload
+        logger.warning("Could not publish pipeline changes", exc_info=True)
+
+
+def latest_pipeline_event() -> Optional[str]:
+    """
+    Position in the change stream for a page rendered now, or None if there
+    are no live updates.
+    """
+    r = get_redis()
+    if r is None:
+        return None
+    try:
+        entries = r.xrevrange(PIPELINE_EVENTS_KEY, count=1)
+    except redis.RedisError:
+        logger.warning("Could not read pipeline changes", exc_info=True)
+        return None
+    return entries[0][0].decode() if len(entries) > 0 else "0-0"
+
+
+def pipeline_changes_since(position: str) -> tuple[str, set[int]]:
+    """The new position and the pipelines changed after `position`"""
+    r = get_redis()
+    if r is None:
+        return position, set()
+    try:
+        streams = r.xread({PIPELINE_EVENTS_KEY: position}, count=_MAX_EVENTS)
+    except redis.RedisError:
+        logger.warning("Could not read pipeline changes", exc_info=True)
+        return position, set()
+
+    changed = set()
+    for _, entries in streams:
+        for entry_id, fields in entries:
+            position = entry_id.decode()
+            changed.update(int(i) for i in fields[b"ids"].decode().split(","))
+    return position, changed
@@ -0,0 +1,48 @@
+import functools
+import hashlib
+from pathlib import Path
+from typing import Iterable
+
+from flask import current_app, render_template
+from markupsafe import Markup
+
+from apogee.cache import cache
+from apogee.model import db as model
+
+# entries of replaced versions are evicted by the writers, this is a backstop
+_EXPIRE = 24 * 60 * 60
+
+
+@functools.cache
+def templates_version() -> str:
+    """Hash of all templates, so changed markup isn't served from a cache"""
+    h = hashlib.sha256()
+    for path in sorted(Path(current_app.root_path, "templates").rglob("*.html")):
+        h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+def _pipeline_tag(pipeline_id: int) -> str:
+    return f"fragment_pipeline_{pipeline_id}"
+
+
+def render_pipeline(pipeline: model.Pipeline, expanded: bool = False) -> Markup:
+    """
+    `pipeline.html` for `pipeline`, from the shared cache if this version of the
+    pipeline has been rendered before. The template must not depend on anything
+    but the pipeline and `expanded`.
+    """
+    key = (
+        f"{_pipeline_tag(pipeline.id)}_{pipeline.updated_at.isoformat()}_"
+        f"{pipeline.refreshed_at.isoformat()}_{int(expanded)}_{templates_version()}"
+    )
+    html = cache.get(key)
+    if html is None:
+        html = render_template("pipeline.html", pipeline=pipeline, expanded=expanded)
+        cache.set(key, html, expire=_EXPIRE, tag=_pipeline_tag(pipeline.id))
+    return Markup(html)
+
+
+def evict_pipeline_fragments(pipeline_ids: Iterable[int]) -> None:
+    for pipeline_id in set(pipeline_ids):
+        cache.evict(_pipeline_tag(pipeline_id))
@@ -1,17 +1,31 @@
+import asyncio
 import datetime
-from typing import cast
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
 
 import gidgethub.apps
 import aiohttp
-from gidgethub.aiohttp import GitHubAPI
 import gidgethub.abc
 import pydantic
 
-from apogee.cache import cache
+from apogee.cache import cache, memoize
+from apogee.http import GitHubAPI, client_session, close_client_session
 from apogee import config
 from apogee.model import db as model
 from apogee.model.db import PrCommitAssociation, db
-from apogee.model.github import Commit, PullRequest
+from apogee.model.github import Commit, CompareResponse, PullRequest
+from apogee.model.totals import invalidate_totals
+from apogee.model.upsert import (
+    sync_pull_request_commits,
+    upsert_commits,
+    upsert_users,
+)
+from apogee.util import gather_limit
+
+logger = logging.getLogger(__name__)
 
 
 class InstallationToken(pydantic.BaseModel):
@@ -19,16 +33,58 @@ class InstallationToken(pydantic.BaseModel):
     expires_at: datetime.datetime
 
 
-async def get_installation_token(
-    session: aiohttp.ClientSession, installation_id: int
-) -> str:
-    key = f"installation_token_{installation_id}"
-    if key in cache:
-        return cast(str, cache.get(key))
+# tokens are treated as expired a bit early, for clock skew and requests in flight
+_EXPIRY_MARGIN = datetime.timedelta(seconds=60)
+# how long to wait for someone else's refresh before fetching a token ourselves
+_REFRESH_TIMEOUT = 30
+# background refreshes start at most this often, so a failing one isn't hammered
+_REFRESH_RETRY_SECONDS = 10
+
+# in front of the disk cache, which is shared with the other processes
+_tokens: Dict[int, InstallationToken] = {}
+_refresh_locks: Dict[int, threading.Lock] = {}
+_refresh_locks_lock = threading.Lock()
+_last_refresh_attempts: Dict[int, float] = {}
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+def _token_key(installation_id: int) -> str:
+    return f"installation_token_{installation_id}"
+
+
+def _is_valid(token: InstallationToken) -> bool:
+    return _now() < token.expires_at - _EXPIRY_MARGIN
+
+
+def _needs_refresh(token: InstallationToken) -> bool:
+    ahead = datetime.timedelta(seconds=config.GITHUB_TOKEN_REFRESH_AHEAD_SECONDS)
+    return _now() >= token.expires_at - ahead
+
 
+def _lookup_token(installation_id: int) -> Optional[InstallationToken]:
+    """Newest valid token known to this process or in the disk cache"""
+    token = _tokens.get(installation_id)
+    if token is None or _needs_refresh(token):
+        # another process might have renewed it already
+        entry = cache.get(_token_key(installation_id))
+        if isinstance(entry, InstallationToken) and (
+            token is None or entry.expires_at > token.expires_at
+        ):
+            token = _tokens[installation_id] = entry
+    if token is None or not _is_valid(token):
+        return None
+    return token
+
+
+async def _fetch_installation_token(
+    session: aiohttp.ClientSession, installation_id: int
+) -> InstallationToken:
     gh = GitHubAPI(session, "herald")
 
-    response = InstallationToken(
+    token = InstallationToken(
         **await gidgethub.apps.get_installation_access_token(
             gh,
             app_id=config.GITHUB_APP_ID,
@@ -38,25 +94,130 @@ async def get_installation_token(
     )
 
     cache.set(
-        key,
-        response.token,
-        expire=(
-            response.expires_at - datetime.datetime.now(tz=datetime.timezone.utc)
-        ).total_seconds()
-        - 60,
+        _token_key(installation_id),
+        token,
+        expire=(token.expires_at - _now() - _EXPIRY_MARGIN).total_seconds(),
     )
+    _tokens[installation_id] = token
+    return token
+
+
+async def _refresh_installation_token(
+    session: aiohttp.ClientSession, installation_id: int
+) -> Optional[InstallationToken]:
+    """
+    Fetch a new token, unless a refresh is already running in this or another
+    process. Returns None in that case.
+    """
+    with _refresh_locks_lock:
+        lock = _refresh_locks.setdefault(installation_id, threading.Lock())
+    if not lock.acquire(blocking=False):
+        return None
+    try:
+        lock_key = f"installation_token_lock_{installation_id}"
+        if not cache.add(lock_key, os.getpid(), expire=_REFRESH_TIMEOUT):
+            return None
+        try:
+            return await _fetch_installation_token(session, installation_id)
+        finally:
+            cache.delete(lock_key)
+    finally:
+        lock.release()
+
+
+def _refresh_in_background(installation_id: int) -> None:
+    with _refresh_locks_lock:
+        now = time.monotonic()
+        last_attempt = _last_refresh_attempts.get(installation_id)
+        if last_attempt is not None and now - last_attempt < _REFRESH_RETRY_SECONDS:
+            return
+        _last_refresh_attempts[installation_id] = now
+
+    async def refresh() -> None:
+        try:
+            await _refresh_installation_token(client_session(), installation_id)
+        except Exception:
+            # the current token is still good, a later call tries again
+            logger.warning(
+                "Refreshing token of installation %d failed",
+                installation_id,
+                exc_info=True,
+            )
+        finally:
+            await close_client_session()
 
-    return response.token
+    threading.Thread(target=asyncio.run, args=(refresh(),), daemon=True).start()
+
+
+async def get_installation_token(
+    session: aiohttp.ClientSession, installation_id: int
+) -> str:
+    """
+    Installation tokens are kept in memory and in the disk cache, and renewed
+    in the background shortly before they expire. Only one thread across all
+    processes fetches a new token at a time, the others wait for its result.
+    """
+    token = _lookup_token(installation_id)
+    if token is not None:
+        if _needs_refresh(token):
+            _refresh_in_background(installation_id)
+        return token.token
+
+    deadline = time.monotonic() + _REFRESH_TIMEOUT
+    while True:
+        token = await _refresh_installation_token(session, installation_id)
+        if token is not None:
+            return token.token
+
+        await asyncio.sleep(0.1)
+        token = _lookup_token(installation_id)
+        if token is not None:
+            return token.token
+
+        if time.monotonic() > deadline:
+            logger.warning(
+                "Timed out waiting for token of installation %d", installation_id
+            )
+            token = await _fetch_installation_token(session, installation_id)
+            return token.token
 
 
 async def get_installation_github(
     session: aiohttp.ClientSession, installation_id: int
 ) -> GitHubAPI:
     token = await get_installation_token(session, installation_id)
-    return GitHubAPI(session, "apogee", oauth_token=token)
+    return GitHubAPI(
+        session,
+        "apogee",
+        oauth_token=token,
+        cache_identity=f"installation_{installation_id}",
+    )
 
 
-async def fetch_commits(gh: gidgethub.abc.GitHubAPI) -> int:
+async def get_repository_installation_id(session: aiohttp.ClientSession) -> int:
+    """The app's installation on `config.REPOSITORY`, for work without a webhook"""
+    key = f"installation_id_{config.REPOSITORY}"
+    installation_id = cache.get(key)
+    if installation_id is None:
+        jwt = gidgethub.apps.get_jwt(
+            app_id=config.GITHUB_APP_ID, private_key=config.GITHUB_APP_PRIVATE_KEY
+        )
+        installation = await GitHubAPI(session, "apogee").getitem(
+            f"/repos/{config.REPOSITORY}/installation", jwt=jwt
+        )
+        installation_id = installation["id"]
+        cache.set(key, installation_id, expire=24 * 60 * 60)
+    return installation_id
+
+
+async def get_repository_github(session: aiohttp.ClientSession) -> GitHubAPI:
+    installation_id = await get_repository_installation_id(session)
+    return await get_installation_github(session, installation_id)
+
+
+async def fetch_commits(
+    gh: gidgethub.abc.GitHubAPI, progress: Callable[[str], None] = lambda _: None
+) -> int:
     n_fetched = 0
 
     # get highest order of commit
@@ -67,7 +228,13 @@ async def fetch_commits(gh: gidgethub.abc.GitHubAPI) -> int:
 
     fetched_commits: list[Commit] = []
 
-    async for data in gh.getiter(f"/repos/{config.REPOSITORY}/commits"):
+    url = f"/repos/{config.REPOSITORY}/commits?per_page=100"
+    if latest_commit is not None:
+        # commit dates on the main branch are not strictly ordered, leave some slack
+        since = latest_commit.committed_date - datetime.timedelta(days=1)
+        url += f"&since={since.strftime('%Y-%m-%dT%H:%M:%SZ')}"
+
+    async for data in gh.getiter(url):
         if n_fetched >= config.MAX_COMMITS:
             break
 
@@ -78,54 +245,126 @@ async def fetch_commits(gh: gidgethub.abc.GitHubAPI) -> int:
 
         n_fetched += 1
         fetched_commits.append(api_commit)
+        progress(f"Fetched {n_fetched} commits")
 
-    for index, api_commit in enumerate(reversed(fetched_commits)):
-        author: model.GitHubUser | None = None
-        committer: model.GitHubUser | None = None
+    upsert_commits(
+        [
+            (api_commit, latest_order + index + 1)
+            for index, api_commit in enumerate(reversed(fetched_commits))
+        ]
+    )
+
+    db.session.commit()
+    invalidate_totals()
 
-        if api_commit.author is not None:
-            author = model.GitHubUser.from_api(api_commit.author)
-            db.session.merge(author)
+    return n_fetched
+
+
+def update_pull_request(pr: PullRequest, commits: list[Commit] | None) -> None:
+    upsert_users((pr.user, pr.head.user, pr.base.user))
 
-        if api_commit.committer is not None:
-            committer = model.GitHubUser.from_api(api_commit.committer)
-            db.session.merge(committer)
+    db.session.merge(model.PullRequest.from_api(pr))
 
-        commit = model.Commit.from_api(api_commit)
-        commit.author = author
-        commit.committer = committer
-        commit.order = latest_order + index + 1
-        db.session.merge(commit)
+    if commits is not None:
+        sync_pull_request_commits(pr.number, commits)
 
     db.session.commit()
+    invalidate_totals()
 
-    return n_fetched
 
+@memoize(key="pulls", expire=60 * 5)
+async def get_pulls(gh: gidgethub.abc.GitHubAPI) -> List[PullRequest]:
+    prs: List[PullRequest] = []
+    async for data in gh.getiter(f"/repos/{config.REPOSITORY}/pulls"):
+        pr = PullRequest(**data)
 
-def update_pull_request(pr: PullRequest, commits: list[Commit] | None) -> None:
-    for user in (pr.user, pr.head.user, pr.base.user):
-        db.session.merge(model.GitHubUser.from_api(user))
+        prs.append(pr)
 
-    db_pr = model.PullRequest.from_api(pr)
+    return prs
 
-    db.session.merge(db_pr)
 
-    if commits is not None:
-        db_pr.commits.clear()
-        db.session.execute(
-            db.delete(PrCommitAssociation).filter_by(pull_request_number=db_pr.number)
-        )
+async def reload_pulls(
+    gh: gidgethub.abc.GitHubAPI, progress: Callable[[str], None] = lambda _: None
+) -> tuple[int, int]:
+    """
+    Update open pull requests, and the ones that were open when we last saw
+    them. Commits are only compared again for pull requests whose head or base
+    moved. Returns the number of updated and of unchanged pull requests.
+    """
+    prs = await get_pulls(gh)
+    progress(f"Fetched {len(prs)} open pull requests")
 
-        for i, commit in enumerate(commits):
-            db_commit = model.Commit.from_api(commit)
-            db_commit.order = -1
-            db.session.merge(db_commit)
+    # fetch PRs that are not in `pr` because they're not currently open, but we
+    # still have them locally as open, and update them as well
+    remote_current_open = [pr.number for pr in prs]
 
-            assoc = PrCommitAssociation(
-                pull_request_number=db_pr.number, commit_sha=commit.sha, order=i
+    local_current_open = db.session.execute(
+        db.select(model.PullRequest).where(
+            model.PullRequest.state == "open",
+            model.PullRequest.number.not_in(remote_current_open),
+        )
+    ).scalars()
+
+    prs += [
+        PullRequest(**pr)
+        for pr in await gather_limit(
+            15,
+            *[
+                gh.getitem(f"/repos/{config.REPOSITORY}/pulls/{pr.number}")
+                for pr in local_current_open
+            ],
+        )
+    ]
+
+    # the commit list only changes with head or base, keep it for the others
+    stored_shas = {
+        number: (head_sha, base_sha)
+        for number, head_sha, base_sha in db.session.execute(
+            db.select(
+                model.PullRequest.number,
+                model.PullRequest.head_sha,
+                model.PullRequest.base_sha,
             )
-            db.session.add(assoc)
+            .where(model.PullRequest.number.in_([pr.number for pr in prs]))
+            .where(
+                db.select(PrCommitAssociation)
+                .where(
+                    PrCommitAssociation.pull_request_number
+                    == model.PullRequest.number
+                )
+                .exists()
+            )
+        )
+    }
+    changed = []
+    unchanged = []
+    for pr in prs:
+        if stored_shas.get(pr.number) == (pr.head.sha, pr.base.sha):
+            unchanged.append(pr)
+        else:
+            changed.append(pr)
+
+    n_compared = 0
+
+    async def compare(pr: PullRequest) -> CompareResponse:
+        nonlocal n_compared
+        result = CompareResponse(
+            **await gh.getitem(
+                f"/repos/{config.REPOSITORY}/compare/{pr.base.sha}...{pr.head.sha}"
+            )
+        )
+        n_compared += 1
+        progress(f"Compared {n_compared} of {len(changed)} changed pull requests")
+        return result
 
-            db_pr.commits.append(assoc)
+    all_compare = await gather_limit(15, *[compare(pr) for pr in changed])
+
+    for pr, compare_result in zip(changed, all_compare):
+        update_pull_request(pr, compare_result.commits)
+
+    for pr in unchanged:
+        update_pull_request(pr, None)
 
     db.session.commit()
+
+    return len(changed), len(unchanged)
@@ -0,0 +1,217 @@
+from datetime import datetime, timedelta, timezone
+from typing import Callable, List
+
+import gidgetlab
+from gidgetlab.abc import GitLabAPI
+
+from apogee import config
+from apogee.model import db as model
+from apogee.model.db import KeyValue, db
+from apogee.model.gitlab import Pipeline
+from apogee.fragments import evict_pipeline_fragments
+from apogee.model.upsert import upsert_pipelines
+from apogee.util import gather_limit
+
+
+def get_last_pipeline_refresh() -> datetime | None:
+    obj = db.session.execute(
+        db.select(KeyValue).where(KeyValue.key == "last_pipeline_refresh")
+    ).scalar_one_or_none()
+    if obj is None:
+        return None
+    return datetime.fromisoformat(obj.value)
+
+
+def set_last_pipeline_refresh(to: datetime):
+    obj = KeyValue(key="last_pipeline_refresh", value=to.isoformat())
+    db.session.merge(obj)
+    db.session.commit()
+
+
+def get_unmatched_pipelines() -> dict[int, tuple[str, datetime]]:
+    """
+    Pipelines that were listed before we knew their commit, as
+    `id: (source sha, created_at)`.
+    """
+    obj = db.session.execute(
+        db.select(KeyValue).where(KeyValue.key == "unmatched_pipelines")
+    ).scalar_one_or_none()
+    if obj is None:
+        return {}
+    return {
+        int(pipeline_id): (sha, datetime.fromisoformat(created_at))
+        for pipeline_id, (sha, created_at) in obj.value.items()
+    }
+
+
+def set_unmatched_pipelines(pipelines: dict[int, tuple[str, datetime]]):
+    obj = KeyValue(
+        key="unmatched_pipelines",
+        value={
+            str(pipeline_id): [sha, created_at.isoformat()]
+            for pipeline_id, (sha, created_at) in pipelines.items()
+        },
+    )
+    db.session.merge(obj)
+
+
+async def reload_pipelines(
+    gl: GitLabAPI,
+    full: bool = False,
+    progress: Callable[[str], None] = lambda _: None,
+) -> tuple[int, int]:
+    """
+    Update pipelines that changed since the last refresh, minus a safety
+    overlap, skipping those whose `updated_at` matches what we have stored.
+    With `full`, or if there was no refresh yet, all pipelines updated within
+    the configured window are refetched, as well as all pipelines we still have
+    as running. Pipelines whose commit we don't know yet are remembered, and
+    fetched once the commit shows up. Returns the number of pipelines listed
+    and updated.
+    """
+    now = datetime.now(tz=timezone.utc)
+    window_start = now - timedelta(days=config.GITLAB_PIPELINES_WINDOW_DAYS)
+    updated_after = window_start
+
+    last_refresh = get_last_pipeline_refresh()
+    incremental = not full and last_refresh is not None
+    if incremental:
+        assert last_refresh is not None
+        updated_after = max(
+            updated_after,
+            last_refresh
+            - timedelta(minutes=config.GITLAB_PIPELINES_REFRESH_OVERLAP_MINUTES),
+        )
+
+    pipelines: List[Pipeline] = []
+
+    url = (
+        f"/projects/{config.GITLAB_PROJECT_ID}/pipelines"
+        + f"?updated_after={updated_after:%Y-%m-%dT%H:%M:%SZ}"
+    )
+    async for pipeline in gl.getiter(url):
+        pipelines.append(Pipeline(**pipeline))
+        if len(pipelines) % 20 == 0:
+            progress(f"Listed {len(pipelines)} pipelines")
+
+    n_listed = len(pipelines)
+
+    if incremental:
+        # skip pipelines that haven't changed since we last wrote them
+        stored_updated_at = dict(
+            db.session.execute(
+                db.select(model.Pipeline.id, model.Pipeline.updated_at).where(
+                    model.Pipeline.id.in_([p.id for p in pipelines])
+                )
+            ).all()
+        )
+        pipelines = [
+            p
+            for p in pipelines
+            if stored_updated_at.get(p.id) != p.updated_at.replace(tzinfo=None)
+        ]
+    else:
+        # let's add pipelines that we currently have as running. In incremental
+        # mode, these would have been listed if they had changed.
+        updated_ids = {p.id for p in pipelines}
+
+        for pipeline in db.session.execute(
+            db.select(model.Pipeline).where(
+                model.Pipeline.status.not_in(
+                    ["success", "failed", "skipped", "canceled"]
+                )
+            )
+        ).scalars():
+            if pipeline.id in updated_ids:
+                continue
+            pipelines.append(
+                Pipeline(
+                    id=pipeline.id,
+                    iid=pipeline.iid,
+                    project_id=pipeline.project_id,
+                    sha=pipeline.sha,
+                    ref=pipeline.ref,
+                    status=pipeline.status,
+                    source=pipeline.source,
+                    created_at=pipeline.created_at,
+                    updated_at=pipeline.updated_at,
+                    web_url=pipeline.web_url,
+                    variables=pipeline.variables,
+                )
+            )
+
+    # pipelines we skipped earlier because we didn't know their commit yet,
+    # until they drop out of the window
+    unmatched = {
+        pipeline_id: (sha, created_at)
+        for pipeline_id, (sha, created_at) in get_unmatched_pipelines().items()
+        if created_at > window_start.replace(tzinfo=None)
+    }
+    listed_ids = {p.id for p in pipelines}
+    known_now = set(
+        db.session.execute(
+            db.select(model.Commit.sha).where(
+                model.Commit.sha.in_({sha for sha, _ in unmatched.values()})
+            )
+        ).scalars()
+    )
+    for pipeline_id, (sha, _) in list(unmatched.items()):
+        if sha not in known_now:
+            continue
+        del unmatched[pipeline_id]
+        if pipeline_id not in listed_ids:
+            url = f"/projects/{config.GITLAB_PROJECT_ID}/pipelines/{pipeline_id}"
+            try:
+                pipelines.append(Pipeline(**await gl.getitem(url)))
+            except gidgetlab.BadRequest as e:
+                if e.status_code != 404:
+                    raise
+                # deleted in the meantime
+
+    n_fetched = 0
+
+    async def fetch(pipeline: Pipeline) -> None:
+        nonlocal n_fetched
+        await pipeline.fetch(gl)
+        n_fetched += 1
+        progress(f"Fetched {n_fetched} of {len(pipelines)} pipelines")
+
+    progress(f"Fetching {len(pipelines)} of {n_listed} pipelines")
+    await gather_limit(
+        config.GITLAB_CONCURRENCY_LIMIT, *[fetch(pipeline) for pipeline in pipelines]
+    )
+
+    # we only care about pipelines for commits we know about
+    known_shas = set(
+        db.session.execute(
+            db.select(model.Commit.sha).where(
+                model.Commit.sha.in_(
+                    [
+                        p.variables["SOURCE_SHA"]
+                        for p in pipelines
+                        if "SOURCE_SHA" in p.variables
+                    ]
+                )
+            )
+        ).scalars()
+    )
+
+    updated = [
+        pipeline
+        for pipeline in pipelines
+        if pipeline.variables.get("SOURCE_SHA") in known_shas
+    ]
+    upsert_pipelines(updated, refreshed_at=datetime.utcnow())
+
+    for pipeline in pipelines:
+        sha = pipeline.variables.get("SOURCE_SHA")
+        if sha is not None and sha not in known_shas:
+            unmatched[pipeline.id] = (sha, pipeline.created_at.replace(tzinfo=None))
+    set_unmatched_pipelines(unmatched)
+
+    db.session.commit()
+    evict_pipeline_fragments(pipeline.id for pipeline in updated)
+
+    set_last_pipeline_refresh(now)
+
+    return n_listed, len(pipelines)
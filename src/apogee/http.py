@@ -0,0 +1,164 @@
+import asyncio
+import atexit
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, Mapping, Optional, Tuple
+import weakref
+
+import aiohttp
+import gidgethub.aiohttp
+import gidgetlab.aiohttp
+from multidict import CIMultiDict
+
+from apogee import config
+from apogee.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# one pooled session per event loop, aiohttp sessions can't be shared across loops
+_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = weakref.WeakKeyDictionary()
+_sessions_lock = threading.Lock()
+
+
+def client_session() -> aiohttp.ClientSession:
+    """
+    Pooled client session for the running event loop. Connections to GitHub
+    and GitLab are kept alive and DNS lookups are cached between calls.
+    The session must not be closed by the caller.
+    """
+    loop = asyncio.get_running_loop()
+    with _sessions_lock:
+        session = _sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=config.HTTP_CONNECTION_LIMIT,
+                limit_per_host=config.HTTP_CONNECTION_LIMIT_PER_HOST,
+                ttl_dns_cache=config.HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT,
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            _sessions[loop] = session
+    return session
+
+
+async def close_client_session() -> None:
+    """Close the pooled session of the running event loop, if any"""
+    with _sessions_lock:
+        session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+def close_all_client_sessions() -> None:
+    """
+    Close the pooled sessions of all event loops that are not currently
+    running, e.g. on worker shutdown.
+    """
+    with _sessions_lock:
+        sessions = list(_sessions.items())
+        _sessions.clear()
+
+    for loop, session in sessions:
+        if session.closed or loop.is_closed():
+            continue
+        if loop.is_running():
+            logger.warning("Not closing client session of running event loop")
+            continue
+        loop.run_until_complete(session.close())
+
+
+atexit.register(close_all_client_sessions)
+
+
+_STATS_KEYS = ("hits", "misses", "bytes_saved")
+
+# these describe the 304 response itself, not the cached body we replay
+_NOT_REPLAYED_HEADERS = {"content-length", "content-type", "content-encoding"}
+
+
+def _cache_key(identity: str, url: str, headers: Mapping[str, str]) -> str:
+    h = hashlib.sha256()
+    for part in (identity, url, headers.get("accept", "")):
+        h.update(part.encode())
+        h.update(b"\0")
+    return f"http_cache_{h.hexdigest()}"
+
+
+def cache_stats() -> Dict[str, int]:
+    return {k: cache.get(f"http_cache_stats_{k}", 0) for k in _STATS_KEYS}
+
+
+def reset_cache_stats() -> None:
+    for k in _STATS_KEYS:
+        cache.delete(f"http_cache_stats_{k}")
+
+
+class ConditionalRequestMixin:
+    """
+    Revalidate GET requests with `If-None-Match` / `If-Modified-Since` using the
+    validators of the last response, and replay the stored body if the server
+    answers 304 Not Modified. GitHub does not count those against the rate
+    limit, and we skip downloading and parsing the payload again.
+
+    Responses can depend on who is asking, so they are stored per
+    `cache_identity`, e.g. the installation or user login. Tokens rotate, so
+    they can't be used for this. Clients without an identity don't cache.
+    """
+
+    def __init__(self, *args: Any, cache_identity: Optional[str] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_identity = cache_identity
+
+    async def _request(
+        self, method: str, url: str, headers: Mapping[str, str], body: bytes = b""
+    ) -> Tuple[int, Mapping[str, str], bytes]:
+        if method != "GET" or self.cache_identity is None:
+            return await super()._request(method, url, headers, body)  # type: ignore
+
+        key = _cache_key(self.cache_identity, url, headers)
+        entry = cache.get(key)
+
+        headers = dict(headers)
+        if entry is not None:
+            etag, last_modified, _, _ = entry
+            if etag is not None:
+                headers["if-none-match"] = etag
+            if last_modified is not None:
+                headers["if-modified-since"] = last_modified
+
+        status, response_headers, response_body = await super()._request(  # type: ignore
+            method, url, headers, body
+        )
+
+        if status == 304 and entry is not None:
+            _, _, cached_headers, cached_body = entry
+            replayed = CIMultiDict(cached_headers)
+            # rate limit and validators come from the fresh response
+            for k, v in response_headers.items():
+                if k.lower() not in _NOT_REPLAYED_HEADERS:
+                    replayed[k] = v
+            cache.incr("http_cache_stats_hits")
+            cache.incr("http_cache_stats_bytes_saved", len(cached_body))
+            return 200, replayed, cached_body
+
+        cache.incr("http_cache_stats_misses")
+
+        etag = response_headers.get("etag")
+        last_modified = response_headers.get("last-modified")
+        if status == 200 and (etag is not None or last_modified is not None):
+            cache.set(
+                key,
+                (etag, last_modified, list(response_headers.items()), response_body),
+                expire=config.HTTP_CACHE_EXPIRE_DAYS * 24 * 60 * 60,
+            )
+
+        return status, response_headers, response_body
+
+
+class GitHubAPI(ConditionalRequestMixin, gidgethub.aiohttp.GitHubAPI):
+    pass
+
+
+class GitLabAPI(ConditionalRequestMixin, gidgetlab.aiohttp.GitLabAPI):
+    pass
@@ -1,22 +1,26 @@
 import datetime
-from typing import Any, Optional
+from typing import Any, Iterable, Optional
 
 from flask_sqlalchemy import SQLAlchemy
 import sqlalchemy.sql.functions as func
 from sqlalchemy import (
     Column,
+    Index,
     MetaData,
     String,
     Integer,
     ForeignKey,
     JSON,
+    UniqueConstraint,
+    column,
     event,
     null,
     select,
 )
 from sqlalchemy.engine import Engine
-from sqlalchemy.orm import Mapped, mapped_column, relationship, Session
+from sqlalchemy.orm import Mapped, mapped_column, relationship
 
+from apogee import config
 from apogee.model.github import (
     Commit as ApiCommit,
     User as ApiUser,
@@ -46,6 +50,16 @@ db = SQLAlchemy(
 
 
 class Commit(db.Model):
+    __table_args__ = (
+        # timeline only ever looks at commits on the main branch
+        Index(
+            "ix_commit_order_main",
+            "order",
+            postgresql_where=column("order") >= 0,
+            sqlite_where=column("order") >= 0,
+        ),
+    )
+
     sha: Mapped[str] = mapped_column(String(length=40), primary_key=True)
 
     url: Mapped[str] = mapped_column()
@@ -71,7 +85,17 @@ class Commit(db.Model):
 
     order: Mapped[int] = mapped_column()
 
-    pipelines: Mapped[list["Pipeline"]] = relationship(back_populates="commit")
+    pipelines: Mapped[list["Pipeline"]] = relationship(
+        foreign_keys="Pipeline.source_sha", back_populates="commit"
+    )
+
+    # denormalized pointer to the newest pipeline, see `update_latest_pipelines`
+    latest_pipeline_id: Mapped[Optional[int]] = mapped_column(
+        ForeignKey("pipeline.id", use_alter=True)
+    )
+    latest_pipeline: Mapped[Optional["Pipeline"]] = relationship(
+        foreign_keys=[latest_pipeline_id], post_update=True
+    )
 
     patches: Mapped[list["Patch"]] = relationship(cascade="all, delete-orphan")
 
@@ -92,22 +116,6 @@ class Commit(db.Model):
     def subject(self) -> str:
         return self.message.split("\n")[0]
 
-    @property
-    def latest_pipeline(self) -> Optional["Pipeline"]:
-        session = Session.object_session(self)
-        assert session is not None
-        # @TODO: Refactor: slow
-        return (
-            session.execute(
-                select(Pipeline)
-                .filter_by(source_sha=self.sha)
-                .order_by(Pipeline.created_at.desc())
-                .limit(1)
-            )
-            .scalars()
-            .one_or_none()
-        )
-
 
 class Patch(db.Model):
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
@@ -151,6 +159,8 @@ class GitHubUser(db.Model):
 
 
 class PullRequest(db.Model):
+    __table_args__ = (Index("ix_pull_request_state_updated_at", "state", "updated_at"),)
+
     number: Mapped[int] = mapped_column(primary_key=True)
     url: Mapped[str] = mapped_column()
     html_url: Mapped[str] = mapped_column()
@@ -227,33 +237,16 @@ class PullRequest(db.Model):
             mergeable=pull.mergeable if pull.mergeable is not None else True,
         )
 
-    @property
-    def latest_pipeline(self) -> Optional["Pipeline"]:
-        pipeline_select = (
-            db.select(
-                Commit.sha,
-                PrCommitAssociation.order,
-                Pipeline,
-                func.max(Pipeline.created_at),
-            )
-            .where(PrCommitAssociation.pull_request_number == self.number)
-            .join(PrCommitAssociation.commit)
-            .join(Commit.pipelines)
-            .group_by(Commit.sha, Pipeline.id, PrCommitAssociation.order)
-            .order_by(PrCommitAssociation.order.desc())
-            .limit(1)
-        )
-
-        result = db.session.execute(pipeline_select).one_or_none()
-
-        if result is None:
-            return None
-
-        _, _, pipeline, _ = result
-        return pipeline
-
 
 class PrCommitAssociation(db.Model):
+    __table_args__ = (
+        Index(
+            "ix_pr_commit_association_pull_request_number_order",
+            "pull_request_number",
+            "order",
+        ),
+    )
+
     pull_request_number: Mapped[int] = mapped_column(
         ForeignKey("pull_request.number"), primary_key=True
     )
@@ -265,6 +258,12 @@ class PrCommitAssociation(db.Model):
 
 
 class Pipeline(db.Model):
+    __table_args__ = (
+        Index("ix_pipeline_source_sha_created_at", "source_sha", "created_at"),
+        # version token of the cached views, see `apogee.web.util.check_etag`
+        Index("ix_pipeline_refreshed_at", "refreshed_at"),
+    )
+
     id: Mapped[int] = mapped_column(primary_key=True)
     iid: Mapped[int] = mapped_column(unique=True)
     project_id: Mapped[int] = mapped_column()
@@ -288,6 +287,26 @@ class Pipeline(db.Model):
 
     refreshed_at: Mapped[datetime.datetime] = mapped_column()
 
+    # job counts by stage and status, see `update_job_summaries`
+    job_summary: Mapped[Optional[dict[str, Any]]] = mapped_column(JSON)
+
+    @property
+    def stages(self) -> list[tuple[str, list["Job"]]]:
+        """Jobs grouped by stage in pipeline order, sorted by name"""
+        by_stage: dict[str, list[Job]] = {}
+        for job in self.jobs:
+            by_stage.setdefault(job.stage, []).append(job)
+        return [
+            (stage, sorted(by_stage[stage], key=lambda j: j.name))
+            for stage in order_stages(by_stage)
+        ]
+
+    @property
+    def duration(self) -> datetime.timedelta | None:
+        if self.job_summary is None or self.job_summary["duration"] is None:
+            return None
+        return datetime.timedelta(seconds=self.job_summary["duration"])
+
     @property
     def refreshed_delta(self):
         return datetime.datetime.utcnow() - self.refreshed_at
@@ -323,7 +342,7 @@ class Job(db.Model):
     web_url: Mapped[str] = mapped_column()
     failure_reason: Mapped[str | None] = mapped_column()
 
-    pipeline_id: Mapped[int] = mapped_column(ForeignKey("pipeline.id"))
+    pipeline_id: Mapped[int] = mapped_column(ForeignKey("pipeline.id"), index=True)
     pipeline: Mapped["Pipeline"] = relationship("Pipeline", back_populates="jobs")
 
     @classmethod
@@ -345,6 +364,222 @@ class Job(db.Model):
         )
 
 
+class ReferenceUpdate(db.Model):
+    """Status of updating the references from one failed job of a pipeline"""
+
+    __table_args__ = (UniqueConstraint("pipeline_id", "job_id"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+
+    pipeline_id: Mapped[int] = mapped_column(ForeignKey("pipeline.id"))
+    pipeline: Mapped["Pipeline"] = relationship()
+
+    job_id: Mapped[int] = mapped_column()
+    job_name: Mapped[str] = mapped_column()
+    qtest: Mapped[str] = mapped_column()
+    version: Mapped[str] = mapped_column()
+
+    # pending, running, success or failed
+    status: Mapped[str] = mapped_column(default="pending")
+    trace: Mapped[str] = mapped_column(default="")
+
+    updated_at: Mapped[datetime.datetime] = mapped_column(
+        default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow
+    )
+
+    @property
+    def stale(self) -> bool:
+        """Pending or running, but its task hasn't reported back in a while"""
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+            minutes=config.REFERENCE_UPDATE_STALE_MINUTES
+        )
+        return self.status in ("pending", "running") and self.updated_at < cutoff
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("pending", "running") and not self.stale
+
+
 class KeyValue(db.Model):
     key: Mapped[str] = mapped_column(primary_key=True)
     value: Mapped[Any] = mapped_column(JSON)
+
+
+def _latest_pipeline_id():
+    return (
+        select(Pipeline.id)
+        .where(Pipeline.source_sha == Commit.sha)
+        .order_by(Pipeline.created_at.desc(), Pipeline.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+
+
+def update_latest_pipelines(shas: Iterable[str] | None = None) -> None:
+    """
+    Point `Commit.latest_pipeline_id` at the newest pipeline of each commit.
+    Has to be called whenever pipelines are written. If `shas` is not given,
+    all commits are updated.
+    """
+    stmt = (
+        db.update(Commit)
+        .values(latest_pipeline_id=_latest_pipeline_id())
+        .execution_options(synchronize_session=False)
+    )
+    if shas is not None:
+        shas = list(set(shas))
+        if len(shas) == 0:
+            return
+        stmt = stmt.where(Commit.sha.in_(shas))
+    db.session.execute(stmt)
+
+
+def order_stages(stages: Iterable[str]) -> list[str]:
+    """Build stage first, report stage last, the others alphabetically"""
+    rank = {"build": 0, "report": 2}
+    return sorted(set(stages), key=lambda stage: (rank.get(stage, 1), stage))
+
+
+def summarize_jobs(
+    groups: Iterable[
+        tuple[str, str, bool, int, datetime.datetime | None, datetime.datetime | None]
+    ],
+) -> dict[str, Any]:
+    """
+    Build a job summary from `(stage, status, allow_failure, count,
+    first started_at, last finished_at)` groups. Allowed failures are counted
+    separately from failures.
+    """
+    counts: dict[str, dict[str, int]] = {}
+    started = []
+    finished = []
+    for stage, status, allow_failure, count, started_at, finished_at in groups:
+        if status == "failed" and allow_failure:
+            status = "allowed_failure"
+        stage_counts = counts.setdefault(stage, {})
+        stage_counts[status] = stage_counts.get(status, 0) + count
+        if started_at is not None:
+            started.append(started_at)
+        if finished_at is not None:
+            finished.append(finished_at)
+
+    duration = None
+    if len(started) > 0 and len(finished) > 0:
+        duration = max(0.0, (max(finished) - min(started)).total_seconds())
+
+    return {
+        "stages": [
+            {"name": stage, "counts": counts[stage]} for stage in order_stages(counts)
+        ],
+        "duration": duration,
+    }
+
+
+# pipelines per statement, keeps the bound parameters and rows in memory in check
+_JOB_SUMMARY_CHUNK_SIZE = 500
+
+
+def _update_job_summaries_chunk(ids: list[int]) -> None:
+    groups: dict[int, list] = {pipeline_id: [] for pipeline_id in ids}
+    for pipeline_id, *group in db.session.execute(
+        select(
+            Job.pipeline_id,
+            Job.stage,
+            Job.status,
+            Job.allow_failure,
+            func.count(),
+            func.min(Job.started_at),
+            func.max(Job.finished_at),
+        )
+        .where(Job.pipeline_id.in_(ids))
+        .group_by(Job.pipeline_id, Job.stage, Job.status, Job.allow_failure)
+    ):
+        groups[pipeline_id].append(group)
+
+    db.session.execute(
+        db.update(Pipeline),
+        [
+            {"id": pipeline_id, "job_summary": summarize_jobs(pipeline_groups)}
+            for pipeline_id, pipeline_groups in groups.items()
+        ],
+    )
+
+
+def update_job_summaries(pipeline_ids: Iterable[int] | None = None) -> None:
+    """
+    Recompute `Pipeline.job_summary` from the jobs table. Has to be called
+    whenever jobs are written. If `pipeline_ids` is not given, all pipelines
+    are updated.
+    """
+    if pipeline_ids is not None:
+        ids = sorted(set(pipeline_ids))
+        for i in range(0, len(ids), _JOB_SUMMARY_CHUNK_SIZE):
+            _update_job_summaries_chunk(ids[i : i + _JOB_SUMMARY_CHUNK_SIZE])
+        return
+
+    last_id = None
+    while True:
+        query = select(Pipeline.id).order_by(Pipeline.id).limit(_JOB_SUMMARY_CHUNK_SIZE)
+        if last_id is not None:
+            query = query.where(Pipeline.id > last_id)
+        ids = list(db.session.execute(query).scalars())
+        if len(ids) == 0:
+            return
+        _update_job_summaries_chunk(ids)
+        last_id = ids[-1]
+
+
+def find_stale_latest_pipelines() -> list[tuple[str, int | None, int | None]]:
+    """
+    Return `(sha, stored, expected)` for every commit whose `latest_pipeline_id`
+    does not point at its newest pipeline.
+    """
+    expected = _latest_pipeline_id()
+    select_stale = select(Commit.sha, Commit.latest_pipeline_id, expected).where(
+        Commit.latest_pipeline_id.is_distinct_from(expected)
+    )
+    return list(db.session.execute(select_stale).tuples())
+
+
+def latest_pipelines_for_commits(shas: Iterable[str]) -> dict[str, Pipeline]:
+    """Map commit sha to its latest pipeline, for commits that have one"""
+    pipeline_select = (
+        select(Commit.sha, Pipeline)
+        .join(Pipeline, Commit.latest_pipeline_id == Pipeline.id)
+        .where(Commit.sha.in_(list(shas)))
+    )
+    return {sha: pipeline for sha, pipeline in db.session.execute(pipeline_select)}
+
+
+def latest_pipelines_for_pulls(numbers: Iterable[int]) -> dict[int, Pipeline]:
+    """
+    Map pull request number to the latest pipeline of the newest commit in the
+    pull request that has any pipeline, in a single query.
+    """
+    ranked = (
+        select(
+            PrCommitAssociation.pull_request_number,
+            Commit.latest_pipeline_id,
+            func.rank()
+            .over(
+                partition_by=PrCommitAssociation.pull_request_number,
+                order_by=PrCommitAssociation.order.desc(),
+            )
+            .label("rank"),
+        )
+        .join(PrCommitAssociation.commit)
+        .where(
+            PrCommitAssociation.pull_request_number.in_(list(numbers)),
+            Commit.latest_pipeline_id.is_not(None),
+        )
+        .subquery()
+    )
+
+    pipeline_select = (
+        select(ranked.c.pull_request_number, Pipeline)
+        .join(Pipeline, Pipeline.id == ranked.c.latest_pipeline_id)
+        .where(ranked.c.rank == 1)
+    )
+    return {
+        number: pipeline for number, pipeline in db.session.execute(pipeline_select)
+    }
@@ -0,0 +1,43 @@
+from typing import cast
+
+import sqlalchemy.sql.functions as func
+from sqlalchemy.sql import Select
+
+from apogee.cache import cache
+from apogee.model.db import Commit, PullRequest, db
+
+# counts shown next to the paginated lists, dropped by the ingestion paths
+# whenever they write commits or pull requests
+_KEYS = ("totals_timeline_commits", "totals_open_pulls")
+
+# in case a write path forgets to invalidate
+_EXPIRE = 60 * 60
+
+
+def _cached_count(key: str, select: Select) -> int:
+    total = cache.get(key)
+    if total is None:
+        total = cast(int, db.session.execute(select).scalar())
+        cache.set(key, total, expire=_EXPIRE)
+    return total
+
+
+def timeline_commits_total() -> int:
+    return _cached_count(
+        "totals_timeline_commits",
+        db.select(func.count()).select_from(Commit).where(Commit.order >= 0),
+    )
+
+
+def open_pulls_total() -> int:
+    return _cached_count(
+        "totals_open_pulls",
+        db.select(func.count())
+        .select_from(PullRequest)
+        .where(PullRequest.state == "open"),
+    )
+
+
+def invalidate_totals() -> None:
+    for key in _KEYS:
+        cache.delete(key)
@@ -0,0 +1,242 @@
+import datetime
+from typing import Any, Iterable, Sequence
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql, sqlite
+
+from apogee.model.db import (
+    Commit,
+    GitHubUser,
+    Job,
+    Pipeline,
+    PrCommitAssociation,
+    db,
+    update_job_summaries,
+    update_latest_pipelines,
+)
+from apogee.model.github import Commit as ApiCommit, User as ApiUser
+from apogee.model.gitlab import Job as ApiJob, Pipeline as ApiPipeline
+
+
+def values(obj: db.Model) -> dict[str, Any]:
+    """Column values that have been set on a (transient) model instance"""
+    state = sqlalchemy.inspect(obj)
+    columns = {attr.key: attr.columns[0].name for attr in state.mapper.column_attrs}
+    return {columns[k]: v for k, v in state.dict.items() if k in columns}
+
+
+def upsert(
+    model: type[db.Model],
+    rows: Sequence[dict[str, Any]],
+    update: Iterable[str] | None = None,
+) -> None:
+    """
+    Insert `rows` into the table of `model`, updating rows whose primary key
+    already exists. Only the columns in `update` are overwritten on conflict,
+    by default all non-key columns present in the rows.
+
+    On PostgreSQL and SQLite this is a single batched
+    `INSERT ... ON CONFLICT DO UPDATE`, other databases fall back to
+    `session.merge` per row.
+    """
+    if len(rows) == 0:
+        return
+
+    table = model.__table__
+    primary_key = [c.name for c in table.primary_key]
+
+    if update is None:
+        update = [k for k in rows[0] if k not in primary_key]
+
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(table)
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(table)
+    else:
+        for row in rows:
+            db.session.merge(model(**row))
+        return
+
+    update = list(update)
+    if len(update) > 0:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=primary_key,
+            set_={c: stmt.excluded[c] for c in update},
+        )
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=primary_key)
+
+    # flush pending ORM changes first, so the rows we reference exist
+    db.session.flush()
+    db.session.execute(stmt, list(rows))
+
+
+def upsert_pipelines(
+    pipelines: Sequence[ApiPipeline],
+    refreshed_at: datetime.datetime,
+    keep_updated_at: bool = False,
+) -> None:
+    """
+    Write pipelines including all of their jobs. Jobs that are no longer part
+    of a pipeline are deleted, and the latest pipeline pointer of the affected
+    commits is updated. Statement count is independent of the number of jobs.
+
+    `updated_at` is GitLab's, as of the last time we read the pipeline from the
+    API. Webhooks don't carry it, they keep the stored one with `keep_updated_at`.
+    """
+    if len(pipelines) == 0:
+        return
+
+    pipeline_rows = []
+    job_rows = []
+    for pipeline in pipelines:
+        db_pipeline = Pipeline.from_api(pipeline)
+        db_pipeline.refreshed_at = refreshed_at
+        pipeline_rows.append(values(db_pipeline))
+
+        for job in pipeline.jobs:
+            db_job = Job.from_api(job)
+            db_job.pipeline_id = pipeline.id
+            job_rows.append(values(db_job))
+
+    update = [k for k in pipeline_rows[0] if k != "id"]
+    if keep_updated_at:
+        update.remove("updated_at")
+    upsert(Pipeline, pipeline_rows, update=update)
+    upsert(Job, job_rows)
+
+    db.session.execute(
+        db.delete(Job)
+        .where(
+            Job.pipeline_id.in_([p.id for p in pipelines]),
+            Job.id.not_in([row["id"] for row in job_rows]),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+    update_latest_pipelines(row["source_sha"] for row in pipeline_rows)
+    update_job_summaries(row["id"] for row in pipeline_rows)
+
+    # rows were written behind the ORM's back
+    db.session.expire_all()
+
+
+def upsert_jobs(
+    jobs: Sequence[tuple[int, ApiJob]], refreshed_at: datetime.datetime
+) -> int:
+    """
+    Write `(pipeline_id, job)` pairs for pipelines we already know about, and
+    bump `refreshed_at` once per affected pipeline. Returns the number of jobs
+    written.
+    """
+    pipeline_ids = set(
+        db.session.execute(
+            db.select(Pipeline.id).where(Pipeline.id.in_({p for p, _ in jobs}))
+        ).scalars()
+    )
+
+    # a single statement can't update the same row twice, keep the last event
+    latest = {job.id: (pipeline_id, job) for pipeline_id, job in jobs}
+
+    job_rows = []
+    for pipeline_id, job in latest.values():
+        if pipeline_id not in pipeline_ids:
+            continue
+        db_job = Job.from_api(job)
+        db_job.pipeline_id = pipeline_id
+        job_rows.append(values(db_job))
+
+    upsert(Job, job_rows)
+
+    update_job_summaries({row["pipeline_id"] for row in job_rows})
+
+    if len(pipeline_ids) > 0:
+        db.session.execute(
+            db.update(Pipeline)
+            .where(Pipeline.id.in_(pipeline_ids))
+            .values(refreshed_at=refreshed_at)
+            .execution_options(synchronize_session=False)
+        )
+
+    db.session.expire_all()
+
+    return len(job_rows)
+
+
+def upsert_users(users: Iterable[ApiUser]) -> None:
+    """Write GitHub users, each distinct user once"""
+    rows = {user.id: values(GitHubUser.from_api(user)) for user in users}
+    upsert(GitHubUser, list(rows.values()))
+
+
+def upsert_commits(
+    commits: Sequence[tuple[ApiCommit, int]], update_order: bool = True
+) -> None:
+    """
+    Write `(commit, order)` pairs along with their authors and committers.
+    Existing commits get the API fields updated, and `order` unless
+    `update_order` is False. Their note and revert flag are kept.
+    """
+    upsert_users(
+        user
+        for commit, _ in commits
+        for user in (commit.author, commit.committer)
+        if user is not None
+    )
+
+    rows = {}
+    for commit, order in commits:
+        db_commit = Commit.from_api(commit)
+        db_commit.author_id = commit.author.id if commit.author else None
+        db_commit.committer_id = commit.committer.id if commit.committer else None
+        db_commit.order = order
+        rows[commit.sha] = values(db_commit)
+
+    update = None
+    if not update_order and len(rows) > 0:
+        columns = next(iter(rows.values())).keys()
+        update = [c for c in columns if c not in ("sha", "order")]
+    upsert(Commit, list(rows.values()), update=update)
+
+    db.session.expire_all()
+
+
+def sync_pull_request_commits(number: int, commits: Sequence[ApiCommit]) -> None:
+    """
+    Make the commit list of pull request `number` match `commits`. Only
+    associations that were added, removed or moved are written, commits that
+    are new to us are inserted outside the timeline (`order` -1).
+    """
+    upsert_commits([(commit, -1) for commit in commits], update_order=False)
+
+    existing = dict(
+        db.session.execute(
+            db.select(PrCommitAssociation.commit_sha, PrCommitAssociation.order).where(
+                PrCommitAssociation.pull_request_number == number
+            )
+        ).all()
+    )
+    wanted = {commit.sha: order for order, commit in enumerate(commits)}
+
+    removed = existing.keys() - wanted.keys()
+    if len(removed) > 0:
+        db.session.execute(
+            db.delete(PrCommitAssociation)
+            .where(
+                PrCommitAssociation.pull_request_number == number,
+                PrCommitAssociation.commit_sha.in_(removed),
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+    upsert(
+        PrCommitAssociation,
+        [
+            {"pull_request_number": number, "commit_sha": sha, "order": order}
+            for sha, order in wanted.items()
+            if existing.get(sha) != order
+        ],
+    )
+
+    db.session.expire_all()
@@ -0,0 +1,22 @@
+from typing import Optional
+
+import redis
+
+from apogee import config
+
+_client: Optional[redis.Redis] = None
+
+
+def get_redis() -> Optional[redis.Redis]:
+    """
+    Shared client for `config.REDIS_URL`, or None if no Redis is configured,
+    in which case callers should fall back to doing without.
+    """
+    global _client
+    if config.REDIS_URL is None or not config.REDIS_URL.startswith(
+        ("redis://", "rediss://", "unix://")
+    ):
+        return None
+    if _client is None:
+        _client = redis.Redis.from_url(config.REDIS_URL)
+    return _client
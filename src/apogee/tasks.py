@@ -1,20 +1,40 @@
 from datetime import datetime, timezone
+import json
 import logging
 import os
-from typing import Any, Dict
-import aiohttp
+import traceback
+from typing import Any, Callable, Dict, List
 
-from celery import Celery, Task, shared_task
+from celery import Celery, Task, shared_task, signals
 from celery.utils.log import get_task_logger
 from flask import Flask
 
 from apogee import config
-from apogee.github import get_installation_github, update_pull_request
+from apogee.events import publish_pipeline_changes
+from apogee.fragments import evict_pipeline_fragments
+from apogee.http import GitLabAPI, client_session, close_all_client_sessions
+from apogee.github import (
+    get_installation_github,
+    get_repository_github,
+    reload_pulls,
+    update_pull_request,
+)
+from apogee.gitlab import reload_pipelines
 from apogee.model.db import db
 from apogee.model import db as model
+from apogee.model.upsert import upsert_jobs, upsert_pipelines
+from apogee.redis_client import get_redis
 from apogee.model.github import Commit, CompareResponse, PullRequest
 from apogee.model.gitlab import Job, Pipeline
-from apogee.util import coroutine
+from apogee.trace import FINISHED_STATUSES, invalidate_trace_results
+from apogee.util import (
+    coroutine,
+    eos_filesystem,
+    execute_reference_update,
+    get_pipeline_references,
+    parse_pipeline_url,
+    run_reference_updates,
+)
 from apogee.github import fetch_commits
 
 
@@ -49,6 +69,11 @@ def celery_init_app(app: Flask) -> Celery:
     if app.debug:
         logger.setLevel(logging.DEBUG)
 
+    # worker threads keep their event loops and sessions between tasks
+    signals.worker_process_shutdown.connect(
+        lambda **_: close_all_client_sessions(), weak=False
+    )
+
     celery_app.set_default()
     app.extensions["celery"] = celery_app
     return celery_app
@@ -79,6 +104,7 @@ def handle_pipeline_webhook(payload: Dict[str, Any]) -> None:
         status=data["status"],
         source=data["source"],
         created_at=proc_datetime(data["created_at"]),
+        # not in the payload, only used for pipelines we didn't know yet
         updated_at=datetime.now(tz=timezone.utc),
         web_url=f"{config.GITLAB_URL}/{config.GITLAB_PROJECT}/-/pipelines/{data['id']}",
         variables={v["key"]: v["value"] for v in data["variables"]},
@@ -125,23 +151,17 @@ def handle_pipeline_webhook(payload: Dict[str, Any]) -> None:
         logger.info("Ignoring commit %s", api_pipeline.variables["SOURCE_SHA"])
         return
 
-    db_pipeline = model.Pipeline.from_api(api_pipeline)
-    db_pipeline.refreshed_at = datetime.utcnow()
-    db_pipeline = db.session.merge(db_pipeline)
-    db_pipeline.jobs = []
-
-    for job in api_pipeline.jobs:
-        db_job = model.Job.from_api(job)
-        db_job.pipeline_id = db_pipeline.id
-        db.session.merge(db_job)
+    upsert_pipelines(
+        [api_pipeline], refreshed_at=datetime.utcnow(), keep_updated_at=True
+    )
 
     db.session.commit()
+    evict_pipeline_fragments([api_pipeline.id])
+    publish_pipeline_changes([api_pipeline.id])
 
 
-@shared_task(ignore_result=True)
-def handle_job_webhook(payload: Dict[str, Any]) -> None:
-    # we need to already know about this job's pipeline, otherwise it's pointless
-    job = Job(
+def job_from_payload(payload: Dict[str, Any]) -> Job:
+    return Job(
         id=payload["build_id"],
         status=payload["build_status"],
         stage=payload["build_stage"],
@@ -155,26 +175,99 @@ def handle_job_webhook(payload: Dict[str, Any]) -> None:
         failure_reason=payload["build_failure_reason"],
     )
 
-    pipeline_id = payload["pipeline_id"]
-    logger.info("Handling job %s for pipeline %s", job.id, pipeline_id)
 
-    if pipeline_id is None:
-        logger.info("Cannot save job without pipeline id")
-        return
+def handle_job_webhooks(payloads: List[Dict[str, Any]]) -> None:
+    """Write a batch of job events in one transaction"""
+    jobs = []
+    for payload in payloads:
+        # we need to already know about this job's pipeline, otherwise it's pointless
+        if payload["pipeline_id"] is None:
+            logger.info("Cannot save job %s without pipeline id", payload["build_id"])
+            continue
+        jobs.append((payload["pipeline_id"], job_from_payload(payload)))
+
+    n_written = upsert_jobs(jobs, refreshed_at=datetime.utcnow())
+    db.session.commit()
+    evict_pipeline_fragments(pipeline_id for pipeline_id, _ in jobs)
+    publish_pipeline_changes(pipeline_id for pipeline_id, _ in jobs)
+
+    logger.info("Wrote %d of %d jobs", n_written, len(payloads))
+
+    for _, job in jobs:
+        if job.status not in FINISHED_STATUSES:
+            # the job is running (again), forget what we parsed from its trace
+            invalidate_trace_results(job.id)
+
+
+@shared_task(ignore_result=True)
+def handle_job_webhook(payload: Dict[str, Any]) -> None:
+    handle_job_webhooks([payload])
+
 
-    if pipeline := db.session.execute(
-        db.select(model.Pipeline).filter_by(id=pipeline_id)
-    ).scalar_one_or_none():
-        pipeline.refreshed_at = datetime.utcnow()
-    else:
-        # ignore these, we don't care about these jobs
-        logger.info("Ignoring job %s", job.id)
+JOB_BUFFER_KEY = "apogee:job_webhooks"
+JOB_FLUSH_SCHEDULED_KEY = "apogee:job_webhooks:flush_scheduled"
+
+
+def buffer_job_webhook(payload: Dict[str, Any]) -> None:
+    """
+    Queue a job event for the next batch write. Only the latest event per job
+    is kept. The first event after a flush schedules the next one, a full
+    buffer is flushed right away. Without redis, events are handled one by one.
+    """
+    r = get_redis()
+    if r is None:
+        handle_job_webhook.delay(payload)
         return
 
-    db_job = model.Job.from_api(job)
-    db.session.merge(db_job)
+    pipe = r.pipeline()
+    pipe.hset(JOB_BUFFER_KEY, str(payload["build_id"]), json.dumps(payload))
+    pipe.hlen(JOB_BUFFER_KEY)
+    # expires in case the scheduled flush gets lost
+    pipe.set(
+        JOB_FLUSH_SCHEDULED_KEY,
+        1,
+        nx=True,
+        px=config.JOB_WEBHOOK_FLUSH_INTERVAL_MS * 20,
+    )
+    added, size, scheduled = pipe.execute()
 
-    db.session.commit()
+    if scheduled:
+        flush_job_webhooks.apply_async(
+            countdown=config.JOB_WEBHOOK_FLUSH_INTERVAL_MS / 1000
+        )
+    elif added and size == config.JOB_WEBHOOK_BATCH_SIZE:
+        # only the event that fills the buffer triggers this, not every later one
+        flush_job_webhooks.delay()
+
+
+@shared_task(ignore_result=True)
+def flush_job_webhooks() -> None:
+    r = get_redis()
+    assert r is not None
+
+    # events arriving from now on schedule the next flush
+    r.delete(JOB_FLUSH_SCHEDULED_KEY)
+
+    pipe = r.pipeline(transaction=True)
+    pipe.hgetall(JOB_BUFFER_KEY)
+    pipe.delete(JOB_BUFFER_KEY)
+    buffered, _ = pipe.execute()
+
+    if len(buffered) == 0:
+        return
+
+    try:
+        handle_job_webhooks([json.loads(v) for v in buffered.values()])
+    except Exception:
+        # put them back unless a newer event for the job came in meanwhile
+        pipe = r.pipeline()
+        for job_id, payload in buffered.items():
+            pipe.hsetnx(JOB_BUFFER_KEY, job_id, payload)
+        pipe.execute()
+        flush_job_webhooks.apply_async(
+            countdown=config.JOB_WEBHOOK_FLUSH_INTERVAL_MS / 1000
+        )
+        raise
 
 
 @shared_task(ignore_result=True)
@@ -186,10 +279,9 @@ async def handle_push(payload: Dict[str, Any]) -> None:
 
     logger.info("Handling push %s for repo %s", head_commit_sha, repo)
 
-    async with aiohttp.ClientSession() as session:
-        gh = await get_installation_github(session, installation_id)
+    gh = await get_installation_github(client_session(), installation_id)
 
-        await fetch_commits(gh)
+    await fetch_commits(gh)
 
 
 @shared_task(ignore_result=True)
@@ -200,15 +292,138 @@ async def handle_pull_request(payload: Dict[str, Any]) -> None:
 
     pr_compare: CompareResponse | None = None
     if payload["action"] in ("opened", "synchronize"):
-        async with aiohttp.ClientSession() as session:
-            gh = await get_installation_github(session, installation_id)
+        gh = await get_installation_github(client_session(), installation_id)
 
-            pr_compare = CompareResponse(
-                **await gh.getitem(
-                    f"/repos/{config.REPOSITORY}/compare/{pr.base.sha}...{pr.head.sha}"
-                )
+        pr_compare = CompareResponse(
+            **await gh.getitem(
+                f"/repos/{config.REPOSITORY}/compare/{pr.base.sha}...{pr.head.sha}"
             )
+        )
 
     update_pull_request(pr, pr_compare.commits if pr_compare else None)
 
     db.session.commit()
+
+
+def report_progress(task: Task) -> Callable[[str], None]:
+    def progress(message: str) -> None:
+        task.update_state(state="PROGRESS", meta={"message": message})
+
+    return progress
+
+
+@shared_task(bind=True)
+@coroutine
+async def reload_pipelines_task(self: Task, full: bool = False) -> Dict[str, str]:
+    gl = GitLabAPI(
+        client_session(),
+        "apogee",
+        access_token=config.GITLAB_TOKEN,
+        url=config.GITLAB_URL,
+        cache_identity="apogee",
+    )
+    n_listed, n_updated = await reload_pipelines(
+        gl, full=full, progress=report_progress(self)
+    )
+
+    return {"message": f"Updated {n_updated} of {n_listed} changed pipelines"}
+
+
+@shared_task(bind=True)
+@coroutine
+async def reload_commits_task(self: Task) -> Dict[str, str]:
+    gh = await get_repository_github(client_session())
+    n_fetched = await fetch_commits(gh, progress=report_progress(self))
+
+    return {"message": f"Fetched {n_fetched} commits"}
+
+
+@shared_task(bind=True)
+@coroutine
+async def reload_pulls_task(self: Task) -> Dict[str, str]:
+    gh = await get_repository_github(client_session())
+    n_updated, n_skipped = await reload_pulls(gh, progress=report_progress(self))
+
+    return {
+        "message": f"{n_updated} pull requests compared, "
+        f"{n_skipped} skipped as unchanged"
+    }
+
+
+@shared_task(ignore_result=True)
+@coroutine
+async def update_references_task(pipeline_id: int, job_ids: List[int]) -> None:
+    pipeline = db.session.get(model.Pipeline, pipeline_id)
+    assert pipeline is not None, f"Pipeline {pipeline_id} not found"
+    owner, repo, _ = parse_pipeline_url(pipeline.web_url)
+
+    updates = {
+        u.job_id: u
+        for u in db.session.execute(
+            db.select(model.ReferenceUpdate).where(
+                model.ReferenceUpdate.pipeline_id == pipeline_id,
+                model.ReferenceUpdate.job_id.in_(job_ids),
+            )
+        ).scalars()
+    }
+
+    def fail(update: model.ReferenceUpdate, message: str) -> None:
+        update.status = "failed"
+        update.trace += message + "\n"
+        db.session.commit()
+
+    gl = GitLabAPI(
+        client_session(),
+        "apogee",
+        access_token=config.GITLAB_TOKEN,
+        url=config.GITLAB_URL,
+        cache_identity="apogee",
+    )
+
+    try:
+        eos = eos_filesystem()
+        refs = [
+            ref
+            for ref in await get_pipeline_references(gl, owner, repo, pipeline_id)
+            if ref[0].id in updates
+        ]
+    except Exception as e:
+        for update in updates.values():
+            fail(update, f"Failed: {e!r}")
+        raise
+
+    for job_id in updates.keys() - {job.id for job, _, _ in refs}:
+        fail(updates[job_id], "Reference override no longer found in job trace")
+
+    async def run_update(job: Job, qtest: str, version: str) -> None:
+        ref_update = updates[job.id]
+        ref_update.status = "running"
+        ref_update.trace = ""
+        db.session.commit()
+
+        def progress(line: str) -> None:
+            ref_update.trace += line + "\n"
+            db.session.commit()
+
+        try:
+            await execute_reference_update(
+                client_session(),
+                gl,
+                eos,
+                owner,
+                repo,
+                job,
+                qtest,
+                version,
+                dry_run=False,
+                progress=progress,
+            )
+        except Exception:
+            logger.exception("Reference update from job %d failed", job.id)
+            fail(ref_update, traceback.format_exc())
+            raise
+
+        ref_update.status = "success"
+        db.session.commit()
+
+    await run_reference_updates(refs, run_update)
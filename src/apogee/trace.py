@@ -0,0 +1,253 @@
+import codecs
+import re
+from typing import Awaitable, Callable, Optional, Protocol, TypeVar
+
+from gidgetlab.abc import GitLabAPI
+
+from apogee import config
+from apogee.cache import cache
+from apogee.http import client_session
+from apogee.model.gitlab import Job
+
+T = TypeVar("T", covariant=True)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class LineMatcher(Protocol[T]):
+    """
+    Consumes a job trace line by line (without the trailing newline). `feed`
+    returns True once the matcher has what it needs and reading can stop.
+    """
+
+    def feed(self, line: str) -> bool: ...
+
+    def reset(self) -> None: ...
+
+    @property
+    def result(self) -> Optional[T]: ...
+
+
+class ReferenceOverrideMatcher:
+    """Finds the q-test and reference version a job compared against"""
+
+    pattern = re.compile(
+        r"Checking for reference override at http.+/q(\d+)/v(\d+)/myAOD.pool.root"
+    )
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self._result: Optional[tuple[str, str]] = None
+
+    def feed(self, line: str) -> bool:
+        m = self.pattern.search(line)
+        if m is None:
+            return False
+        qtest, version = m.groups()
+        self._result = qtest, version
+        return True
+
+    @property
+    def result(self) -> Optional[tuple[str, str]]:
+        return self._result
+
+
+class ObjectCountsDiffMatcher:
+    """
+    Finds the first object counts diff, i.e. everything after a line ending in
+    "Comparing against reference" that starts with a `--- <file>.ref` and a
+    `+++ <file>` header, up to " -- FAILURE". The result is the reference file
+    name and the diff.
+    """
+
+    start_marker = "Comparing against reference"
+    end_marker = " -- FAILURE"
+    ref_pattern = re.compile(r"--- (.+?)\.ref")
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self._state = "idle"
+        self._ref_file: Optional[str] = None
+        self._lines: list[str] = []
+        self._result: Optional[tuple[str, str]] = None
+
+    def _restart(self, line: str) -> None:
+        self._lines = []
+        self._ref_file = None
+        self._state = "start" if line.endswith(self.start_marker) else "idle"
+
+    def feed(self, line: str) -> bool:
+        if self._state == "idle":
+            self._restart(line)
+        elif self._state == "start":
+            m = self.ref_pattern.match(line)
+            if m is None:
+                self._restart(line)
+            else:
+                self._ref_file = m.group(1) + ".ref"
+                self._lines = [line]
+                self._state = "old"
+        elif self._state == "old":
+            if line.startswith("+++ ") and len(line) > 4:
+                self._lines.append(line)
+                self._state = "diff"
+            else:
+                self._restart(line)
+        elif self._state == "diff":
+            idx = line.find(self.end_marker)
+            if idx == -1:
+                self._lines.append(line)
+                return False
+            self._lines.append(line[:idx])
+            assert self._ref_file is not None
+            self._result = self._ref_file, "\n".join(self._lines)
+            return True
+        return False
+
+    @property
+    def result(self) -> Optional[tuple[str, str]]:
+        return self._result
+
+
+async def _scan(
+    gl: GitLabAPI, url: str, matcher: LineMatcher, range: Optional[str] = None
+) -> tuple[bool, bool]:
+    """
+    Stream `url` into `matcher`. Returns whether the matcher finished, and
+    whether the server honored the range request.
+    """
+    headers = {"user-agent": gl.requester}
+    if gl.access_token is not None:
+        headers["authorization"] = f"Bearer {gl.access_token}"
+    if range is not None:
+        headers["range"] = range
+
+    async with client_session().get(url, headers=headers) as resp:
+        if resp.status == 416:
+            # range not satisfiable, the log is empty
+            return False, True
+        resp.raise_for_status()
+        partial = resp.status == 206
+
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        # a tail starts in the middle of a line, drop it
+        skip_first = partial and not resp.headers.get("content-range", "").startswith(
+            "bytes 0-"
+        )
+        rest = ""
+        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+            *lines, rest = (rest + decoder.decode(chunk)).split("\n")
+            for line in lines:
+                if skip_first:
+                    skip_first = False
+                    continue
+                if matcher.feed(line):
+                    return True, partial
+
+        rest += decoder.decode(b"", final=True)
+        if rest != "" and not skip_first and matcher.feed(rest):
+            return True, partial
+
+    return False, partial
+
+
+async def scan_trace(
+    gl: GitLabAPI,
+    owner: str,
+    repo: str,
+    job_id: int,
+    matcher: LineMatcher[T],
+    tail_bytes: Optional[int] = None,
+) -> Optional[T]:
+    """
+    Feed the trace of a job to `matcher` in chunks, without holding the whole
+    log in memory, and stop reading as soon as the matcher is done.
+
+    With `tail_bytes`, only the end of the log is requested first. If the
+    matcher does not finish on the tail, the full log is scanned.
+    """
+    url = f"{gl.api_url}projects/{owner}%2F{repo}/jobs/{job_id}/trace"
+
+    if tail_bytes is not None:
+        done, partial = await _scan(gl, url, matcher, range=f"bytes=-{tail_bytes}")
+        if done:
+            return matcher.result
+        if not partial:
+            # we already went through the full log
+            return None
+        matcher.reset()
+
+    await _scan(gl, url, matcher)
+    return matcher.result
+
+
+# the trace of a job in one of these states does not change anymore
+FINISHED_STATUSES = ("success", "failed", "canceled", "skipped")
+
+_RESULT_KINDS = ("reference_override", "object_counts_diff")
+
+
+def _result_key(kind: str, job_id: int) -> str:
+    return f"trace_{kind}_{job_id}"
+
+
+async def _cached_result(
+    kind: str, job: Job, scan: Callable[[], Awaitable[Optional[T]]]
+) -> Optional[T]:
+    """
+    Parsed results of finished jobs are kept by job id, so traces are only
+    downloaded once. `finished_at` is stored along to catch jobs that ran again.
+    """
+    if job.status not in FINISHED_STATUSES:
+        return await scan()
+
+    key = _result_key(kind, job.id)
+    entry = cache.get(key)
+    if entry is not None:
+        finished_at, result = entry
+        if finished_at == job.finished_at:
+            return result
+
+    result = await scan()
+    cache.set(
+        key,
+        (job.finished_at, result),
+        expire=config.TRACE_CACHE_EXPIRE_DAYS * 24 * 60 * 60,
+    )
+    return result
+
+
+def invalidate_trace_results(job_id: int) -> None:
+    for kind in _RESULT_KINDS:
+        cache.delete(_result_key(kind, job_id))
+
+
+async def find_reference_override(
+    gl: GitLabAPI, owner: str, repo: str, job: Job
+) -> Optional[tuple[str, str]]:
+    return await _cached_result(
+        "reference_override",
+        job,
+        lambda: scan_trace(gl, owner, repo, job.id, ReferenceOverrideMatcher()),
+    )
+
+
+async def find_object_counts_diff(
+    gl: GitLabAPI, owner: str, repo: str, job: Job
+) -> Optional[tuple[str, str]]:
+    return await _cached_result(
+        "object_counts_diff",
+        job,
+        lambda: scan_trace(
+            gl,
+            owner,
+            repo,
+            job.id,
+            ObjectCountsDiffMatcher(),
+            tail_bytes=config.TRACE_TAIL_BYTES,
+        ),
+    )
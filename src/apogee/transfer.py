@@ -0,0 +1,162 @@
+import asyncio
+import contextlib
+from dataclasses import dataclass
+import io
+import queue
+import time
+import zlib
+
+import fsspec.spec
+from webdav4.fsspec import WebdavFileSystem
+
+from apogee import config
+from apogee.artifacts import CHUNK_SIZE, RemoteZip, ZipMember
+
+
+class TransferError(Exception):
+    pass
+
+
+@dataclass
+class UploadResult:
+    target: str
+    size: int
+    seconds: float
+
+    def __str__(self) -> str:
+        rate = self.size / self.seconds / 1e6 if self.seconds > 0 else 0
+        return (
+            f"Uploaded {self.target}: {self.size / 1e6:.1f} MB "
+            f"in {self.seconds:.1f}s ({rate:.1f} MB/s), verified"
+        )
+
+
+class _Pipe(io.RawIOBase):
+    """
+    File-like object the uploading thread reads from, while the event loop
+    feeds it chunks. The queue is bounded, so only a few chunks are in memory.
+    """
+
+    def __init__(self, maxsize: int = 8):
+        self._queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self._buffer = b""
+        self._eof = False
+        self.aborted = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while len(self._buffer) == 0:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, BaseException):
+                raise item
+            if item is None:
+                self._eof = True
+                return 0
+            self._buffer = item
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def put(self, item) -> None:
+        while True:
+            if self.aborted:
+                raise TransferError("Upload was aborted")
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+
+def _crc32(fs: fsspec.spec.AbstractFileSystem, path: str) -> int:
+    crc = 0
+    with fs.open(path, "rb", block_size=CHUNK_SIZE) as fh:
+        while chunk := fh.read(CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def matches(fs: fsspec.spec.AbstractFileSystem, path: str, member: ZipMember) -> bool:
+    """Whether `path` exists with the same size and CRC32 as `member`"""
+    if not fs.exists(path) or fs.size(path) != member.file_size:
+        return False
+    return _crc32(fs, path) == member.crc32
+
+
+def _write(
+    fs: fsspec.spec.AbstractFileSystem, path: str, pipe: _Pipe, size: int
+) -> None:
+    try:
+        if isinstance(fs, WebdavFileSystem):
+            # fs.open buffers the whole file locally before sending it
+            fs.client.upload_fileobj(
+                pipe,
+                fs._strip_protocol(path),
+                overwrite=True,
+                size=size,
+                chunk_size=CHUNK_SIZE,
+            )
+        else:
+            with fs.open(path, "wb") as dst:
+                while chunk := pipe.read(CHUNK_SIZE):
+                    dst.write(chunk)
+    except BaseException:
+        pipe.aborted = True
+        raise
+
+
+def _verify(fs: fsspec.spec.AbstractFileSystem, path: str, member: ZipMember) -> None:
+    size = fs.size(path)
+    if size != member.file_size:
+        raise TransferError(
+            f"{path} has {size} bytes after upload, expected {member.file_size}"
+        )
+    if config.REFERENCE_UPLOAD_VERIFY_CHECKSUM and _crc32(fs, path) != member.crc32:
+        raise TransferError(f"Checksum of {path} does not match after upload")
+
+
+async def upload_member(
+    archive: RemoteZip, name: str, fs: fsspec.spec.AbstractFileSystem, target: str
+) -> UploadResult:
+    """
+    Stream an archive member to `target` without staging it on local disk, then
+    check size and checksum of the uploaded file. A failed upload is removed.
+    """
+    member = archive.members[name]
+    pipe = _Pipe()
+    start = time.perf_counter()
+
+    writer = asyncio.create_task(
+        asyncio.to_thread(_write, fs, target, pipe, member.file_size)
+    )
+
+    feed_error = None
+    try:
+        async for chunk in archive.iter_member(name):
+            await asyncio.to_thread(pipe.put, chunk)
+    except BaseException as e:
+        feed_error = e
+
+    if not pipe.aborted:
+        # the writer sees None as the end of the file, or raises the error
+        with contextlib.suppress(TransferError):
+            await asyncio.to_thread(pipe.put, feed_error)
+
+    try:
+        await writer
+        if feed_error is not None:
+            raise feed_error
+        await asyncio.to_thread(_verify, fs, target, member)
+    except BaseException:
+        if await asyncio.to_thread(fs.exists, target):
+            await asyncio.to_thread(fs.rm, target)
+        raise
+
+    return UploadResult(
+        target=target, size=member.file_size, seconds=time.perf_counter() - start
+    )
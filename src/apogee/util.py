@@ -1,22 +1,30 @@
 from datetime import datetime
-import tempfile
-import shutil
 import functools
 from flask import current_app
-from fsspec.implementations.zip import ZipFileSystem
 import re
 import os
 import hashlib
+import threading
 
 import asyncio
+import concurrent.futures
+import contextvars
+from typing import Awaitable, Callable, TypeVar
 
 import aiohttp
 from gidgetlab.abc import GitLabAPI
 import fsspec.spec
+from webdav4.fsspec import WebdavFileSystem
 from apogee import config
+from apogee.artifacts import RemoteZip
+from apogee.http import close_client_session
+from apogee.transfer import matches, upload_member
+from apogee.trace import find_object_counts_diff, find_reference_override
 
 from apogee.model.gitlab import Job, Pipeline as ApiPipeline
 
+T = TypeVar("T")
+
 
 async def gather_limit(n, *coros):
     semaphore = asyncio.Semaphore(n)
@@ -28,10 +36,47 @@ async def gather_limit(n, *coros):
     return await asyncio.gather(*(sem_coro(c) for c in coros))
 
 
+_thread_loop = threading.local()
+
+
+def run_sync(coro):
+    """
+    Run a coroutine on an event loop that lives as long as the current thread,
+    so pooled connections from `apogee.http` are reused across calls.
+    """
+    loop = getattr(_thread_loop, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        _thread_loop.loop = loop
+    return loop.run_until_complete(coro)
+
+
 def coroutine(fn):
+    """
+    Make an async function callable from sync code, e.g. as a Celery task.
+    Calls run on the persistent loop of the calling thread (see `run_sync`), so
+    worker threads keep their client session and open connections between tasks.
+    """
+
     @functools.wraps(fn)
     def wrapper(*args, **kwargs):
-        return asyncio.run(fn(*args, **kwargs))
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return run_sync(fn(*args, **kwargs))
+
+        # called from async code, e.g. an eager task started by an async view,
+        # so use a throwaway loop in another thread
+        async def run():
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                await close_client_session()
+
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            return executor.submit(
+                contextvars.copy_context().run, asyncio.run, run()
+            ).result()
 
     return wrapper
 
@@ -60,27 +105,20 @@ async def get_pipeline_references(
 
     failed_jobs = [j for j in pipeline.jobs if j.status == "failed"]
 
-    traces = await gather_limit(
+    overrides = await gather_limit(
         10,
-        *(
-            gl.getitem(f"/projects/{owner}%2F{repo}/jobs/{j.id}/trace")
-            for j in failed_jobs
-        ),
+        *(find_reference_override(gl, owner, repo, j) for j in failed_jobs),
     )
 
     results = []
 
-    for job, trace in zip(failed_jobs, traces):
+    for job, override in zip(failed_jobs, overrides):
         print("Job", f"#{job.id} {job.name}", "failed")
-        m = re.search(
-            rf"Checking for reference override at http.+/q(\d+)/v(\d+)/myAOD.pool.root",
-            trace,
-        )
-        if m is None:
+        if override is None:
             print("Could not find reference override in trace, skipping this job")
             continue
 
-        qtest, version = m.groups()
+        qtest, version = override
 
         print(f"Job was running q{qtest} and version v{version} of references")
 
@@ -104,36 +142,22 @@ async def get_object_counts_diffs(
 
     failed_jobs = [j for j in pipeline.jobs if j.status == "failed"]
 
-    traces = await gather_limit(
+    diffs = await gather_limit(
         10,
-        *(
-            gl.getitem(f"/projects/{owner}%2F{repo}/jobs/{j.id}/trace")
-            for j in failed_jobs
-        ),
+        *(find_object_counts_diff(gl, owner, repo, j) for j in failed_jobs),
     )
 
     results = []
 
-    for job, trace in zip(failed_jobs, traces):
+    for job, found in zip(failed_jobs, diffs):
         print("Job", f"#{job.id} {job.name}", "failed")
-        
-        # Match from "Comparing against reference" to "FAILURE"
-        m = re.search(
-            r"(?ms)"  # Multiline and dot matches newline
-            r"Comparing against reference\n"  # Start marker
-            r"(--- (.+?)\.ref[^\n]*\n"  # Start capturing: Reference file ending in .ref, with nested capture for filename
-            r"\+\+\+ [^\n]+\n"  # New file
-            r".*?)"  # Any content in between (non-greedy)
-            r" -- FAILURE",  # End marker
-            trace
-        )
-        
-        if m is None:
+
+        # Diff from "Comparing against reference" up to "FAILURE"
+        if found is None:
             print("Could not find object counts diff in trace, skipping this job")
             continue
 
-        diff = m.group(1)  # Get the captured diff content
-        ref_file = m.group(2) + ".ref"  # Get the reference filename
+        ref_file, diff = found
         results.append((job, ref_file, diff))
 
     return results
@@ -270,6 +294,17 @@ def combine_diffs(
     return "\n".join(processed_diffs)
 
 
+def eos_filesystem() -> fsspec.spec.AbstractFileSystem:
+    eos = WebdavFileSystem(
+        "https://cernbox.cern.ch/cernbox/webdav/",
+        auth=(config.EOS_USER_NAME, config.EOS_USER_PWD),
+    )
+
+    assert eos.exists(config.EOS_BASE_PATH), f"{config.EOS_BASE_PATH} does not exist"
+
+    return eos
+
+
 async def execute_reference_update(
     session: aiohttp.ClientSession,
     gl: GitLabAPI,
@@ -280,57 +315,113 @@ async def execute_reference_update(
     qtest: str,
     version: str,
     dry_run: bool,
+    progress: Callable[[str], None] = lambda _: None,
 ):
     eos_q_dir = f"{config.EOS_BASE_PATH}/q{qtest}"
 
     trace = []
 
+    def log(line: str) -> None:
+        trace.append(line)
+        current_app.logger.info("%s", line)
+        progress(line)
+
     eos_version_dir = f"{eos_q_dir}/v{version}"
-    if eos.exists(eos_version_dir):
-        dest = f"{eos_version_dir}.pre_{datetime.now():%Y-%m-%dT%H-%M-%S}"
-        trace += [f"Override dir {eos_version_dir} already exists, moving to {dest}"]
-        current_app.logger.info("%s", trace[-1])
-        if not dry_run:
-            eos.mv(
-                eos_version_dir,
-                dest,
-                recursive=True,
-            )
-    if not dry_run:
-        eos.mkdir(eos_version_dir)
+
     url = f"{gl.api_url}/projects/{owner}%2F{repo}/jobs/{job.id}/artifacts"
-    r = await session.get(url)
-    with tempfile.TemporaryFile() as fh:
-        trace += [f"Downloading artifact {url}"]
-        current_app.logger.info("%s", trace[-1])
-        async for data, _ in r.content.iter_chunks():
-            fh.write(data)
-        current_app.logger.info("Downloaded %d bytes", fh.tell())
-        fh.seek(0)
-        zipfs = ZipFileSystem(fh)
+    log(f"Reading artifact {url}")
+    async with RemoteZip(session, url) as archive:
+        if not archive.is_remote:
+            current_app.logger.info("Range requests not supported, downloaded archive")
         run_path = f"run/run_q{qtest}"
-        assert zipfs.exists(run_path), f"Could not find {run_path} in zip file"
+        assert archive.exists(run_path), f"Could not find {run_path} in zip file"
+
+        targets = {
+            f"{run_path}/my{name}.pool.root": f"my{name}.pool.root"
+            for name in ("AOD", "ESD")
+        }
+        for full_name in targets:
+            assert archive.exists(
+                full_name
+            ), f"Could not find {full_name} in zip file"
+
+        # EOS calls block, keep them off the loop so other jobs can proceed
+        unchanged = set()
+        if await asyncio.to_thread(eos.exists, eos_version_dir):
+            same = await asyncio.gather(
+                *(
+                    asyncio.to_thread(
+                        matches,
+                        eos,
+                        f"{eos_version_dir}/{target}",
+                        archive.members[full_name],
+                    )
+                    for full_name, target in targets.items()
+                )
+            )
+            unchanged = {name for name, is_same in zip(targets, same) if is_same}
+            if len(unchanged) == len(targets):
+                log(f"Override dir {eos_version_dir} is up to date, skipping")
+                return "\n".join(trace)
 
-        current_app.logger.info("Have zip file system")
+            dest = f"{eos_version_dir}.pre_{datetime.now():%Y-%m-%dT%H-%M-%S}"
+            log(f"Override dir {eos_version_dir} already exists, moving to {dest}")
+            if not dry_run:
+                await asyncio.to_thread(
+                    eos.mv,
+                    eos_version_dir,
+                    dest,
+                    recursive=True,
+                )
+        if not dry_run:
+            await asyncio.to_thread(eos.mkdir, eos_version_dir)
 
-        for name in ("AOD", "ESD"):
-            full_name = f"{run_path}/my{name}.pool.root"
-            full_target_name = f"{eos_version_dir}/my{name}.pool.root"
+        uploads = []
+        for full_name, target in targets.items():
+            full_target_name = f"{eos_version_dir}/{target}"
+
+            if full_name in unchanged:
+                # server side copy, nothing to transfer
+                log(f"{full_target_name} is unchanged, copying from {dest}")
+                if not dry_run:
+                    await asyncio.to_thread(
+                        eos.copy, f"{dest}/{target}", full_target_name
+                    )
+                continue
 
-            assert zipfs.exists(full_name), f"Could not find {full_name} in zip file"
             if not dry_run:
-                assert not eos.exists(
-                    full_target_name
+                assert not await asyncio.to_thread(
+                    eos.exists, full_target_name
                 ), f"{full_target_name} already exists"
 
-            trace += [f"Copying {full_name} to {full_target_name}"]
-            current_app.logger.info("%s", trace[-1])
+            log(f"Copying {full_name} to {full_target_name}")
 
             if not dry_run:
-                with zipfs.open(full_name, "rb") as src, eos.open(
-                    full_target_name, "wb"
-                ) as dst:
-                    shutil.copyfileobj(src, dst, length=1024 * 1024 * 10)
-            current_app.logger.info("Copy complete")
+                uploads.append(upload_member(archive, full_name, eos, full_target_name))
+
+        for result in await asyncio.gather(*uploads):
+            log(str(result))
+
+        log(f"Downloaded {archive.bytes_downloaded} bytes of the artifact")
 
     return "\n".join(trace)
+
+
+async def run_reference_updates(
+    refs: list[tuple[Job, str, str]],
+    update: Callable[[Job, str, str], Awaitable[T]],
+) -> list[T | BaseException]:
+    """
+    Run `update` for each reference concurrently, up to
+    `config.REFERENCE_UPDATE_CONCURRENCY` at a time. Jobs writing to the same
+    q-test and version directory run one after the other. Exceptions are
+    returned in place of the result, so one failed job doesn't stop the others.
+    """
+    locks: dict[tuple[str, str], asyncio.Lock] = {}
+    semaphore = asyncio.Semaphore(config.REFERENCE_UPDATE_CONCURRENCY)
+
+    async def run(job: Job, qtest: str, version: str) -> T:
+        async with locks.setdefault((qtest, version), asyncio.Lock()), semaphore:
+            return await update(job, qtest, version)
+
+    return await asyncio.gather(*(run(*ref) for ref in refs), return_exceptions=True)
@@ -1,8 +1,10 @@
 from dataclasses import dataclass
+import functools
 import hashlib
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 import html
 from contextvars import ContextVar
+import json
 import re
 from typing import Any, Dict, List, cast
 from authlib.integrations.flask_client import OAuthError
@@ -21,15 +23,12 @@ from flask import (
 )
 from flask_migrate import Migrate
 from flask_session import Session
-from webdav4.fsspec import WebdavFileSystem
 import redis
 from werkzeug.local import LocalProxy
 import html
 import markdown
 import humanize
-from gidgethub.aiohttp import GitHubAPI
 import gidgethub
-from gidgetlab.aiohttp import GitLabAPI
 import aiohttp
 import sqlalchemy
 import sqlalchemy.exc
@@ -40,39 +39,45 @@ import logging
 from async_lru import alru_cache
 
 from apogee.cli import add_cli
+from apogee.http import GitHubAPI, GitLabAPI, client_session
 from apogee.model.github import User, UserResponse
 from apogee.model.gitlab import CompareResult, Job, Pipeline
 from apogee.model.record import Patch
 from apogee.model.db import db
 from apogee.model import db as model
+from apogee.model.upsert import upsert_pipelines
 from apogee.web.pulls import pull_index_view
 from apogee.web.timeline import timeline_commits_view
 from apogee.web.auth import oauth
 from apogee.web.util import (
-    set_last_pipeline_refresh,
+    add_etag,
+    bump_content_version,
+    check_etag,
+    task_progress,
     with_github,
     with_gitlab,
     with_session,
 )
 from apogee.tasks import (
     celery_init_app,
-    handle_job_webhook,
-    handle_pipeline_webhook,
-    handle_pull_request,
-    handle_push,
+    reload_pipelines_task,
+    update_references_task,
 )
 
 
 from apogee import config
 from apogee.cache import cache
+from apogee.events import latest_pipeline_event, pipeline_changes_since
+from apogee.fragments import evict_pipeline_fragments, render_pipeline
+from apogee.webhooks import dispatch_github_webhook, dispatch_gitlab_webhook
 from apogee.util import (
-    execute_reference_update,
     gather_limit,
     get_object_counts_diffs,
     create_patch_from_diffs,
     combine_diffs,
     get_pipeline_references,
     parse_pipeline_url,
+    run_sync,
 )
 
 logging.basicConfig(format="%(levelname)s %(name)s %(message)s")
@@ -91,9 +96,8 @@ class PatchContent:
 
 @alru_cache(maxsize=128)
 async def load_patch(url: str) -> PatchContent:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            content = await resp.text()
+    async with client_session().get(url) as resp:
+        content = await resp.text()
 
     lines = content.split("\n")
     author, date = lines[1:3]
@@ -109,8 +113,19 @@ async def load_patch(url: str) -> PatchContent:
     return PatchContent(author=author, date=date, subject=subject)
 
 
+class Flask(flask.Flask):
+    def async_to_sync(self, func):
+        # Run async views on a per-thread event loop instead of a new one for
+        # every request, so the pooled HTTP sessions survive between requests
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return run_sync(func(*args, **kwargs))
+
+        return wrapper
+
+
 def create_app():
-    app = flask.Flask(__name__)
+    app = Flask(__name__)
 
     app.config.from_prefixed_env()
     app.config.setdefault("SESSION_TYPE", "sqlalchemy")
@@ -121,7 +136,7 @@ def create_app():
 
     #  logging.getLogger("sqlalchemy.engine").setLevel(logging.INFO)
 
-    celery_init_app(app)
+    celery_app = celery_init_app(app)
 
     app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_host=1)
 
@@ -151,10 +166,15 @@ def create_app():
         return {
             "humanize": humanize,
             "zip": zip,
+            "render_pipeline": render_pipeline,
+            "latest_pipeline_event": latest_pipeline_event,
+            "pipeline_events_poll_seconds": config.PIPELINE_EVENTS_POLL_SECONDS,
             "gh_user": g.gh_user if "gh_user" in g else None,
             "cern_user": g.cern_user if "cern_user" in g else None,
         }
 
+    app.after_request(add_etag)
+
     @app.before_request
     def before_request():
         if "HX-Request" in request.headers and "HX-Boosted" not in request.headers:
@@ -256,101 +276,49 @@ def create_app():
         return redirect(url_for("timeline.index"))
 
     @app.route("/reload_pipelines", methods=["POST"])
-    @with_gitlab
-    async def reload_pipelines(gl: GitLabAPI):
-        updated_after = datetime.now(tz=timezone.utc) - timedelta(
-            days=config.GITLAB_PIPELINES_WINDOW_DAYS
-        )
+    def reload_pipelines():
+        source = request.args["source"]
+        if source not in task_views:
+            abort(400)
 
-        pipelines: List[Pipeline] = []
+        result = reload_pipelines_task.delay(full=request.args.get("full") == "1")
+        return task_progress(result, source, task_views[source])
 
-        url = (
-            f"/projects/{config.GITLAB_PROJECT_ID}/pipelines"
-            + f"?updated_after={updated_after:%Y-%m-%dT%H:%M:%SZ}"
-        )
-        async for pipeline in gl.getiter(url):
-            pipelines.append(Pipeline(**pipeline))
+    task_views = {
+        "timeline": lambda: timeline_commits_view(frame=False),
+        "pulls": lambda: pull_index_view(frame=False),
+    }
 
-        # let's add pipelines that we currently have as running
-        updated_ids = {p.id for p in pipelines}
-
-        for pipeline in db.session.execute(
-            db.select(model.Pipeline).where(
-                model.Pipeline.status.not_in(
-                    ["success", "failed", "skipped", "canceled"]
-                )
-            )
-        ).scalars():
-            if pipeline.id in updated_ids:
-                continue
-            pipelines.append(
-                Pipeline(
-                    id=pipeline.id,
-                    iid=pipeline.iid,
-                    project_id=pipeline.project_id,
-                    sha=pipeline.sha,
-                    ref=pipeline.ref,
-                    status=pipeline.status,
-                    source=pipeline.source,
-                    created_at=pipeline.created_at,
-                    updated_at=pipeline.updated_at,
-                    web_url=pipeline.web_url,
-                    variables=pipeline.variables,
-                )
-            )
+    @app.get("/task/<task_id>")
+    def task_status(task_id: str):
+        source = request.args["source"]
+        if source not in task_views:
+            abort(400)
 
-        await gather_limit(
-            config.GITLAB_CONCURRENCY_LIMIT,
-            *[pipeline.fetch(gl) for pipeline in pipelines],
+        return task_progress(
+            celery_app.AsyncResult(task_id), source, task_views[source]
         )
 
-        for pipeline in pipelines:
-            if "SOURCE_SHA" not in pipeline.variables:
-                # can't associate with commit
-                continue
-
-            if (
-                db.session.execute(
-                    db.select(model.Commit).filter_by(
-                        sha=pipeline.variables["SOURCE_SHA"]
-                    )
-                ).scalar_one_or_none()
-                is None
-            ):
-                # ignore these, we don't care about these commits
-                continue
-
-            db_pipeline = model.Pipeline.from_api(pipeline)
-            db_pipeline.refreshed_at = datetime.utcnow()
-            db.session.merge(db_pipeline)
-
-            db_pipeline.jobs = []
-
-            for job in pipeline.jobs:
-                db_job = model.Job.from_api(job)
-                db_job.pipeline_id = db_pipeline.id
-                db.session.merge(db_job)
-
-        db.session.commit()
-
-        set_last_pipeline_refresh(datetime.now(tz=timezone.utc))
+    def get_reference_updates(pipeline: model.Pipeline) -> list[model.ReferenceUpdate]:
+        return list(
+            db.session.execute(
+                db.select(model.ReferenceUpdate)
+                .where(model.ReferenceUpdate.pipeline_id == pipeline.id)
+                .order_by(model.ReferenceUpdate.job_name)
+            ).scalars()
+        )
 
-        source = request.args["source"]
-        if source not in ("timeline", "pulls"):
-            abort(400)
-        flash(f"Fetched {len(pipelines)} pipelines", "success")
-        if source == "timeline":
-            return timeline_commits_view(frame=False)
-        else:
-            return pull_index_view(frame=False)
+    def reference_updates(pipeline: model.Pipeline) -> str:
+        return render_template(
+            "reference_updates.html",
+            pipeline=pipeline,
+            updates=get_reference_updates(pipeline),
+            next=request.args.get("next"),
+        )
 
     @app.route("/update_references/<int:pipeline_id>", methods=["GET", "POST"])
     @with_gitlab
-    @with_session
-    async def update_references(
-        session: aiohttp.ClientSession, gl: GitLabAPI, pipeline_id: int
-    ):
-
+    async def update_references(gl: GitLabAPI, pipeline_id: int):
         current_app.logger.info(
             "Request to update references from pipeline %d", pipeline_id
         )
@@ -362,30 +330,61 @@ def create_app():
 
         if request.method == "GET":
             return render_template(
-                "update_references.html", pipeline=pipeline, refs=refs
-            )
-        else:
-            eos = WebdavFileSystem(
-                "https://cernbox.cern.ch/cernbox/webdav/",
-                auth=(config.EOS_USER_NAME, config.EOS_USER_PWD),
+                "update_references.html",
+                pipeline=pipeline,
+                refs=refs,
+                updates=get_reference_updates(pipeline),
+                next=request.args.get("next"),
             )
 
-            assert eos.exists(
-                config.EOS_BASE_PATH
-            ), f"{config.EOS_BASE_PATH} does not exist"
+        existing = {
+            u.job_id: u
+            for u in db.session.execute(
+                db.select(model.ReferenceUpdate).filter_by(pipeline_id=pipeline.id)
+            ).scalars()
+        }
 
-            trace = ""
-            for job, qtest, version in await get_pipeline_references(
-                gl, owner, repo, pipeline_id
-            ):
-                trace += "\n" + await execute_reference_update(
-                    session, gl, eos, owner, repo, job, qtest, version, dry_run=False
+        job_ids = []
+        for job, qtest, version in refs:
+            update = existing.get(job.id)
+            if update is None:
+                update = model.ReferenceUpdate(
+                    pipeline_id=pipeline.id, job_id=job.id, job_name=job.name
                 )
+                db.session.add(update)
+            elif update.active:
+                continue
+            update.qtest = qtest
+            update.version = version
+            update.status = "pending"
+            update.trace = ""
+            job_ids.append(job.id)
+        db.session.commit()
+
+        if len(job_ids) > 0:
+            update_references_task.delay(pipeline.id, job_ids)
 
-            trace += "\nDone"
-            print(trace)
+        return reference_updates(pipeline)
 
-            return render_template("update_reference_trace.html", trace=trace)
+    @app.get("/update_references/<int:pipeline_id>/status")
+    def reference_update_status(pipeline_id: int):
+        return reference_updates(db.get_or_404(model.Pipeline, pipeline_id))
+
+    @app.post("/update_references/<int:pipeline_id>/retry/<int:job_id>")
+    def retry_reference_update(pipeline_id: int, job_id: int):
+        pipeline = db.get_or_404(model.Pipeline, pipeline_id)
+        update = db.first_or_404(
+            db.select(model.ReferenceUpdate).filter_by(
+                pipeline_id=pipeline_id, job_id=job_id
+            )
+        )
+        if not update.active:
+            update.status = "pending"
+            update.trace = ""
+            db.session.commit()
+            update_references_task.delay(pipeline_id, [job_id])
+
+        return reference_updates(pipeline)
 
     @app.route("/update_object_counts/<int:pipeline_id>", methods=["GET", "POST"])
     @with_gitlab
@@ -442,24 +441,38 @@ def create_app():
 
     @app.get("/pipeline/<int:pipeline_id>")
     def pipeline(pipeline_id: int):
-        pipeline = (
-            db.session.execute(
-                db.select(model.Pipeline)
-                .where(model.Pipeline.id == pipeline_id)
-                .options(
-                    sqlalchemy.orm.joinedload(model.Pipeline.jobs),
-                    sqlalchemy.orm.raiseload("*"),
-                )
+        refreshed_at = db.session.execute(
+            db.select(model.Pipeline.refreshed_at).where(
+                model.Pipeline.id == pipeline_id
             )
-            .unique()
-            .scalar_one_or_none()
-        )
-        if pipeline is None:
+        ).scalar_one_or_none()
+        if refreshed_at is None:
             abort(404)
+        check_etag(refreshed_at)
+
+        # jobs are only loaded if the fragment is not cached
+        pipeline = db.get_or_404(model.Pipeline, pipeline_id)
 
         expanded = request.args.get("detail", type=bool, default=False)
 
-        return render_template("pipeline.html", pipeline=pipeline, expanded=expanded)
+        return render_pipeline(pipeline, expanded=expanded)
+
+    @app.get("/events")
+    def events():
+        position = request.args.get("since", "")
+        if re.fullmatch(r"\d+-\d+", position) is None:
+            abort(400)
+        position, changed = pipeline_changes_since(position)
+        if len(changed) == 0:
+            # keeps polling from the same position
+            return "", 204
+        # the pipelines listen for these on the body
+        trigger = json.dumps({f"pipeline-{i}": None for i in sorted(changed)})
+        return (
+            render_template("pipeline_events.html", position=position),
+            200,
+            {"HX-Trigger": trigger},
+        )
 
     @app.route("/reload_pipeline/<int:pipeline_id>", methods=["POST"])
     @with_gitlab
@@ -473,25 +486,18 @@ def create_app():
         )
         await api_pipeline.fetch(gl)
 
-        pipeline = model.Pipeline.from_api(api_pipeline)
-        pipeline.refreshed_at = datetime.utcnow()
-        pipeline = db.session.merge(pipeline)
-
-        pipeline.jobs = []
-
-        for job in api_pipeline.jobs:
-            db_job = model.Job.from_api(job)
-            db_job.pipeline_id = pipeline.id
-            db.session.merge(db_job)
+        upsert_pipelines([api_pipeline], refreshed_at=datetime.utcnow())
 
         db.session.commit()
+        evict_pipeline_fragments([pipeline_id])
 
-        return render_template("pipeline.html", pipeline=pipeline, expanded=True)
+        return render_pipeline(pipeline, expanded=True)
 
     @app.route("/reset_patches", methods=["POST"])
     async def reset_patches():
         db.session.execute(sqlalchemy.delete(model.Patch))
         db.session.commit()
+        bump_content_version()
         return "", 200, {"HX-Refresh": "true"}
 
     @app.route("/sync_patches", methods=["GET", "POST"])
@@ -553,6 +559,7 @@ def create_app():
                 target_commit.patches.append(patch)
 
             db.session.commit()
+            bump_content_version()
             return (
                 redirect(url_for("timeline.index")),
                 200,
@@ -562,13 +569,41 @@ def create_app():
     @app.route("/commit/<sha>")
     async def commit_detail(sha: str) -> str:
         is_latest = request.args.get("latest", type=bool, default=False)
+
+        order = db.session.execute(
+            db.select(model.Commit.order).where(model.Commit.sha == sha)
+        ).scalar_one_or_none()
+        if order is None:
+            abort(404)
+        # with a pull request, the pipelines of its other commits are shown too
+        pull_number = request.args.get("pull", type=int)
+        pipelines = db.select(func.max(model.Pipeline.refreshed_at))
+        pull_updated_at = None
+        if pull_number is None:
+            pipelines = pipelines.where(model.Pipeline.source_sha == sha)
+        else:
+            pull_updated_at = db.session.execute(
+                db.select(model.PullRequest.updated_at).where(
+                    model.PullRequest.number == pull_number
+                )
+            ).scalar()
+        check_etag(order, db.session.execute(pipelines).scalar(), pull_updated_at)
+
         commit = db.get_or_404(model.Commit, sha)
         pull: model.PullRequest | None = None
         if number := request.args.get("pull"):
             pull = db.get_or_404(model.PullRequest, int(number))
 
+        latest_pipeline_by_pull = (
+            model.latest_pipelines_for_pulls([pull.number]) if pull is not None else {}
+        )
+
         return render_template(
-            "commit_detail.html", commit=commit, pull=pull, is_latest=is_latest
+            "commit_detail.html",
+            commit=commit,
+            pull=pull,
+            is_latest=is_latest,
+            latest_pipeline_by_pull=latest_pipeline_by_pull,
         )
 
     @app.route("/edit_patches", methods=["GET", "POST"])
@@ -589,6 +624,9 @@ def create_app():
             render_args = {
                 "template_name_or_list": "pull_patches.html",
                 "pull": obj,
+                "latest_pipeline_by_pull": model.latest_pipelines_for_pulls(
+                    [obj.number]
+                ),
             }
         else:
             abort(404)
@@ -617,6 +655,7 @@ def create_app():
                 )
             db.session.add(patch)
             db.session.commit()
+            bump_content_version()
 
             return (
                 render_template(
@@ -670,6 +709,7 @@ def create_app():
         obj.patches = patches
 
         db.session.commit()
+        bump_content_version()
         if sha is not None:
             return render_template(
                 "commit_patches.html",
@@ -680,6 +720,7 @@ def create_app():
             return render_template(
                 "pull_patches.html",
                 pull=obj,
+                latest_pipeline_by_pull=model.latest_pipelines_for_pulls([obj.number]),
                 create_patch=Patch(id=None, url=""),
             )
 
@@ -704,6 +745,7 @@ def create_app():
             if valid:
                 patch.url = url
                 db.session.commit()
+                bump_content_version()
 
             all_patches = list(obj.patches)
             first = all_patches[0] == patch
@@ -726,6 +768,7 @@ def create_app():
         if request.method == "DELETE":
             db.session.delete(patch)
             db.session.commit()
+            bump_content_version()
 
             if sha is not None:
                 return render_template(
@@ -737,6 +780,9 @@ def create_app():
                 return render_template(
                     "pull_patches.html",
                     pull=obj,
+                    latest_pipeline_by_pull=model.latest_pipelines_for_pulls(
+                        [obj.number]
+                    ),
                     create_patch=Patch(id=None, url=""),
                 )
 
@@ -754,6 +800,7 @@ def create_app():
             content = request.form.get("content", "")
             commit.note = content
             db.session.commit()
+            bump_content_version()
 
             return render_template("commit_note.html", commit=commit)
 
@@ -854,6 +901,11 @@ def create_app():
                 patches=patches,
                 patch_contents=patch_contents,
                 pr=pr,
+                latest_pipeline_by_pull=(
+                    model.latest_pipelines_for_pulls([pr.number])
+                    if pr is not None
+                    else {}
+                ),
                 variables=variables,
                 do_report=do_report,
             )
@@ -876,17 +928,10 @@ def create_app():
 
             await pipeline.fetch(gl)
 
-            try:
-                db_pipeline = model.Pipeline.from_api(pipeline)
-                db_pipeline.commit = trigger_commit
-                db_pipeline.refreshed_at = datetime.utcnow()
-                db.session.add(db_pipeline)
-                db.session.commit()
-            except sqlalchemy.exc.IntegrityError:
-                # This can happen because we'll concurrently get webhooks
-                # for the same pipeline
-                # It should result in the same DB state
-                db.session.rollback()
+            # We'll concurrently get webhooks for the same pipeline, the upsert
+            # makes sure this results in the same DB state
+            upsert_pipelines([pipeline], refreshed_at=datetime.utcnow())
+            db.session.commit()
 
             flash(f"Pipeline started: #{pipeline.id}", "success")
             return (
@@ -902,13 +947,12 @@ def create_app():
             )
 
     async def token_valid(token):
-        async with aiohttp.ClientSession() as session:
-            gh = GitHubAPI(session, "username", oauth_token=token)
-            try:
-                await gh.getitem("/user")
-                return True
-            except gidgethub.BadRequest:
-                return False
+        gh = GitHubAPI(client_session(), "username", oauth_token=token)
+        try:
+            await gh.getitem("/user")
+            return True
+        except gidgethub.BadRequest:
+            return False
 
     @app.route("/logout", methods=["POST"])
     def logout():
@@ -927,10 +971,7 @@ def create_app():
         body = request.json
         if body is None:
             return "ok"
-        if body.get("object_kind") == "pipeline":
-            handle_pipeline_webhook.delay(body)
-        if body.get("object_kind") == "build":
-            handle_job_webhook.delay(body)
+        dispatch_gitlab_webhook(body)
 
         return "ok"
 
@@ -943,10 +984,7 @@ def create_app():
         if body is None or event is None:
             return "ok"
 
-        if event == "push":
-            handle_push.delay(body)
-        elif event == "pull_request":
-            handle_pull_request.delay(body)
+        dispatch_github_webhook(event, body)
 
         return "ok"
 
@@ -1,34 +1,22 @@
-import math
-from typing import Iterable, List, Tuple, cast
+import datetime
+from typing import List, Tuple
 
-from flask import Blueprint, flash, render_template, request, url_for
+from flask import Blueprint, abort, render_template, request, url_for
 from gidgethub.abc import GitHubAPI
+import sqlalchemy
 from sqlalchemy.orm import joinedload, raiseload
 import sqlalchemy.sql.functions as func
-from apogee.github import update_pull_request
+from apogee.tasks import reload_pulls_task
 
-from apogee.util import gather_limit
-from apogee.web.util import with_github
-from apogee.cache import memoize
-from apogee.model.github import Commit, CompareResponse, PullRequest
-from apogee import config
+from apogee.web.util import check_etag, task_progress, with_github
+from apogee.model.github import PullRequest
 from apogee.model.db import db
 from apogee.model import db as model
+from apogee.model.totals import open_pulls_total
 
 bp = Blueprint("pulls", __name__, url_prefix="/pulls")
 
 
-@memoize(key="pulls", expire=60 * 5)
-async def get_pulls(gh: GitHubAPI) -> List[PullRequest]:
-    prs: List[PullRequest] = []
-    async for data in gh.getiter(f"/repos/{config.REPOSITORY}/pulls"):
-        pr = PullRequest(**data)
-
-        prs.append(pr)
-
-    return prs
-
-
 class ExtendedPullRequest(PullRequest):
     class Config:
         arbitrary_types_allowed = True
@@ -36,15 +24,40 @@ class ExtendedPullRequest(PullRequest):
     commit: model.Commit
 
 
+def parse_pull_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    updated_at, number = cursor.rsplit("_", 1)
+    return datetime.datetime.fromisoformat(updated_at), int(number)
+
+
+def pull_cursor(pull: model.PullRequest) -> str:
+    return f"{pull.updated_at.isoformat()}_{pull.number}"
+
+
 def get_open_pulls(
-    page: int, per_page: int
-) -> Tuple[Iterable[model.PullRequest], dict[str, model.Pipeline], int]:
+    before: Tuple[datetime.datetime, int] | None, per_page: int
+) -> Tuple[
+    List[model.PullRequest],
+    dict[str, model.Pipeline],
+    dict[int, model.Pipeline],
+    str | None,
+]:
+    """
+    Open pull requests, most recently updated first, after the `(updated_at,
+    number)` cursor `before`. Also returns the cursor of the next page, if any.
+    """
+    select = db.select(model.PullRequest).filter_by(state="open")
+    if before is not None:
+        select = select.filter(
+            sqlalchemy.tuple_(model.PullRequest.updated_at, model.PullRequest.number)
+            < sqlalchemy.tuple_(*before)
+        )
+
     select = (
-        db.select(model.PullRequest)
-        .filter_by(state="open")
-        .order_by(model.PullRequest.updated_at.desc())
-        .offset((page - 1) * per_page)
-        .limit(per_page)
+        select.order_by(
+            model.PullRequest.updated_at.desc(), model.PullRequest.number.desc()
+        )
+        # one extra to see if there is another page
+        .limit(per_page + 1)
         .options(
             joinedload(model.PullRequest.user),
             joinedload(model.PullRequest.patches),
@@ -55,97 +68,64 @@ def get_open_pulls(
         )
     )
 
-    open_pulls: Iterable[model.PullRequest] = (
-        db.session.execute(select).unique().scalars().all()
-    )
+    open_pulls = list(db.session.execute(select).unique().scalars().all())
 
-    total: int = cast(
-        int,
-        db.session.execute(
-            db.select(func.count("*")).where(model.PullRequest.state == "open")
-        ).scalar(),
-    )
+    next_cursor = None
+    if len(open_pulls) > per_page:
+        open_pulls = open_pulls[:per_page]
+        next_cursor = pull_cursor(open_pulls[-1])
 
-    pipeline_select = (
-        db.select(model.Commit.sha, model.Pipeline, func.max(model.Pipeline.created_at))
-        .where(
-            model.PrCommitAssociation.pull_request_number.in_(
-                [p.number for p in open_pulls]
-            )
-        )
-        .join(model.PrCommitAssociation.commit)
-        .join(model.Commit.pipelines)
-        .group_by(model.Commit.sha, model.Pipeline.id)
+    pipeline_by_commit = model.latest_pipelines_for_commits(
+        assoc.commit_sha for pull in open_pulls for assoc in pull.commits
+    )
+    latest_pipeline_by_pull = model.latest_pipelines_for_pulls(
+        pull.number for pull in open_pulls
     )
 
-    pipelines = db.session.execute(pipeline_select).all()
-
-    pipeline_by_commit = {sha: pipeline for sha, pipeline, _ in pipelines}
-    return open_pulls, pipeline_by_commit, total
+    return open_pulls, pipeline_by_commit, latest_pipeline_by_pull, next_cursor
 
 
 @bp.route("/reload_pulls", methods=["POST"])
-@with_github
-async def reload_pulls(gh: GitHubAPI):
-    prs = await get_pulls(gh)
+def reload_pulls():
+    result = reload_pulls_task.delay()
+    return task_progress(result, "pulls", lambda: pull_index_view(frame=False))
 
-    # fetch PRs that are not in `pr` because they're not currently open, but we
-    # still have them locally as open, and update them as well
-    remote_current_open = [pr.number for pr in prs]
 
-    local_current_open = db.session.execute(
-        db.select(model.PullRequest).where(
-            model.PullRequest.state == "open",
-            model.PullRequest.number.not_in(remote_current_open),
-        )
-    ).scalars()
-
-    prs += [
-        PullRequest(**pr)
-        for pr in await gather_limit(
-            15,
-            *[
-                gh.getitem(f"/repos/{config.REPOSITORY}/pulls/{pr.number}")
-                for pr in local_current_open
-            ],
-        )
-    ]
+def pull_index_view(frame: bool) -> str:
+    before = request.args.get("before")
+    try:
+        cursor = parse_pull_cursor(before) if before is not None else None
+    except ValueError:
+        abort(400)
+    per_page = 20
 
-    all_compare = await gather_limit(
-        15,
-        *[
-            gh.getitem(
-                f"/repos/{config.REPOSITORY}/compare/{pr.base.sha}...{pr.head.sha}"
+    # closed pull requests drop out of the list, they also bump `updated_at`
+    check_etag(
+        *db.session.execute(
+            db.select(
+                func.max(model.PullRequest.updated_at),
+                db.select(func.max(model.Pipeline.refreshed_at)).scalar_subquery(),
             )
-            for pr in prs
-        ],
+        ).one()
+    )
+    open_pulls, pipeline_by_commit, latest_pipeline_by_pull, next_cursor = (
+        get_open_pulls(cursor, per_page)
     )
 
-    all_commits = [CompareResponse(**compare).commits for compare in all_compare]
-
-    for pr, commits in zip(prs, all_commits):
-        update_pull_request(pr, commits)
-
-    flash(f"{len(prs)} pull requests updated", "success")
-
-    db.session.commit()
-
-    return pull_index_view(frame=False)
-
-
-def pull_index_view(frame: bool) -> str:
-    page = int(request.args.get("page", 1))
-    per_page = 20
-    open_pulls, pipeline_by_commit, total = get_open_pulls(page, per_page)
+    if request.args.get("scroll") == "1":
+        # infinite scroll, only the next batch of rows
+        template = "pull_page.html"
+    else:
+        template = "pulls.html" if frame else "pull_list.html"
 
     return render_template(
-        "pulls.html" if frame else "pull_list.html",
+        template,
         pulls=open_pulls,
         pipeline_by_commit=pipeline_by_commit,
-        page=page,
-        per_page=per_page,
-        num_pages=math.ceil(total / per_page),
-        total=total,
+        latest_pipeline_by_pull=latest_pipeline_by_pull,
+        before=before,
+        next_cursor=next_cursor,
+        total=open_pulls_total(),
     )
 
 
@@ -160,20 +140,15 @@ async def index(gh: GitHubAPI):
 async def show(gh: GitHubAPI, number: int):
     pull = db.get_or_404(model.PullRequest, number)
 
-    pipeline_select = (
-        db.select(model.Commit.sha, model.Pipeline, func.max(model.Pipeline.created_at))
-        .where(model.PrCommitAssociation.pull_request_number == pull.number)
-        .join(model.PrCommitAssociation.commit)
-        .join(model.Commit.pipelines)
-        .group_by(model.Commit.sha, model.Pipeline.id)
+    pipeline_by_commit = model.latest_pipelines_for_commits(
+        assoc.commit_sha for assoc in pull.commits
     )
 
-    pipelines = db.session.execute(pipeline_select).all()
-
-    pipeline_by_commit = {sha: pipeline for sha, pipeline, _ in pipelines}
-
     return render_template(
-        "single_pull.html", pull=pull, pipeline_by_commit=pipeline_by_commit
+        "single_pull.html",
+        pull=pull,
+        pipeline_by_commit=pipeline_by_commit,
+        latest_pipeline_by_pull=model.latest_pipelines_for_pulls([pull.number]),
     )
 
 
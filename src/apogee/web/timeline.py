@@ -1,15 +1,12 @@
-from typing import cast
-import math
-
-from flask import Blueprint, render_template, flash, request
-from gidgethub.abc import GitHubAPI
+from flask import Blueprint, render_template, request
 import sqlalchemy.orm
 import sqlalchemy.sql.functions as func
-from apogee.github import fetch_commits
+from apogee.tasks import reload_commits_task
 
-from apogee.web.util import with_github
+from apogee.web.util import check_etag, task_progress
 from apogee.model.db import db
 from apogee.model import db as model
+from apogee.model.totals import timeline_commits_total
 from apogee.model.github import Commit
 from apogee import config
 
@@ -17,18 +14,30 @@ bp = Blueprint("timeline", __name__, url_prefix="/timeline")
 
 
 def timeline_commits_view(frame: bool) -> str:
-    page = int(request.args.get("page", 1))
+    # keyset pagination: `before` is the order of the last commit already shown
+    before = request.args.get("before", type=int)
     per_page = 20
 
+    check_etag(
+        *db.session.execute(
+            db.select(
+                func.max(model.Commit.order),
+                db.select(func.max(model.Pipeline.refreshed_at)).scalar_subquery(),
+            ).where(model.Commit.order >= 0)
+        ).one()
+    )
+
+    select = db.select(model.Commit).filter(model.Commit.order >= 0)
+    if before is not None:
+        select = select.filter(model.Commit.order < before)
+
     select = (
-        db.select(model.Commit)
-        .filter(model.Commit.order >= 0)
-        .order_by(model.Commit.order.desc())
-        .offset((page - 1) * per_page)
-        .limit(per_page)
+        select.order_by(model.Commit.order.desc())
+        # one extra to see if there is another page
+        .limit(per_page + 1)
         .options(
             sqlalchemy.orm.joinedload(model.Commit.author),
-            sqlalchemy.orm.joinedload(model.Commit.pipelines),
+            sqlalchemy.orm.joinedload(model.Commit.latest_pipeline),
             sqlalchemy.orm.joinedload(model.Commit.patches),
             sqlalchemy.orm.raiseload("*"),
         )
@@ -36,20 +45,23 @@ def timeline_commits_view(frame: bool) -> str:
 
     commits = db.session.execute(select).scalars().unique().all()
 
-    total: int = cast(
-        int,
-        db.session.execute(
-            db.select(func.count("*")).where(model.Commit.order >= 0)
-        ).scalar(),
-    )
+    next_cursor = None
+    if len(commits) > per_page:
+        commits = commits[:per_page]
+        next_cursor = commits[-1].order
+
+    if request.args.get("scroll") == "1":
+        # infinite scroll, only the next batch of rows
+        template = "commit_page.html"
+    else:
+        template = "timeline.html" if frame else "commits.html"
 
     return render_template(
-        "timeline.html" if frame else "commits.html",
+        template,
         commits=commits,
-        page=page,
-        per_page=per_page,
-        num_pages=math.ceil(total / per_page),
-        total=total,
+        before=before,
+        next_cursor=next_cursor,
+        total=timeline_commits_total(),
     )
 
 
@@ -59,10 +71,6 @@ def index():
 
 
 @bp.route("/reload_commits", methods=["POST"])
-@with_github
-async def reload_commits(gh: GitHubAPI):
-    n_fetched = await fetch_commits(gh)
-
-    flash(f"Fetched {n_fetched} commits", "success")
-
-    return timeline_commits_view(frame=False)
+def reload_commits():
+    result = reload_commits_task.delay()
+    return task_progress(result, "timeline", lambda: timeline_commits_view(frame=False))
@@ -1,24 +1,36 @@
 import asyncio
-from datetime import datetime
 import functools
+import hashlib
+from typing import Any, Callable
 import aiohttp
 import inspect
 
-from flask import session as web_session, redirect, url_for, g
-from gidgethub.aiohttp import GitHubAPI
-from gidgetlab.aiohttp import GitLabAPI
+from celery.result import AsyncResult
+from flask import (
+    Response,
+    abort,
+    current_app,
+    flash,
+    render_template,
+    request,
+    session as web_session,
+    redirect,
+    url_for,
+    g,
+)
 
 from apogee import config
+from apogee.cache import cache
+from apogee.fragments import templates_version
+from apogee.http import GitHubAPI, GitLabAPI, client_session
 from apogee.web.auth import oauth
-from apogee.model.db import KeyValue, db
 
 
 def with_session(fn):
     @functools.wraps(fn)
     async def wrapped(*args, **kwargs):
-        async with aiohttp.ClientSession() as session:
-            kwargs["session"] = session
-            return await fn(*args, **kwargs)
+        kwargs["session"] = client_session()
+        return await fn(*args, **kwargs)
 
     return wrapped
 
@@ -30,11 +42,10 @@ def require_login(fn):
             return redirect(url_for("login_github"))
 
         if "gh_user" not in web_session:
-            async with aiohttp.ClientSession() as session:
-                gh = GitHubAPI(
-                    session, "apogee", oauth_token=str(web_session["gh_token"])
-                )
-                web_session["gh_user"] = await gh.getitem("/user")
+            gh = GitHubAPI(
+                client_session(), "apogee", oauth_token=str(web_session["gh_token"])
+            )
+            web_session["gh_user"] = await gh.getitem("/user")
         g.gh_user = web_session["gh_user"]
 
         return await fn(*args, **kwargs)
@@ -48,7 +59,15 @@ def with_github(fn):
     @require_login
     async def wrapped(*args, session: aiohttp.ClientSession, **kwargs):
         token = oauth.github.token
-        gh = GitHubAPI(session, "username", oauth_token=token["access_token"])
+        # a dict once the session has been stored
+        user = g.gh_user
+        login = user["login"] if isinstance(user, dict) else user.login
+        gh = GitHubAPI(
+            session,
+            "username",
+            oauth_token=token["access_token"],
+            cache_identity=f"user_{login}",
+        )
         kwargs["gh"] = gh
         return await fn(*args, **kwargs)
 
@@ -64,7 +83,11 @@ def with_gitlab(fn):
     @with_session
     async def wrapped(*args, session: aiohttp.ClientSession, **kwargs):
         gl = GitLabAPI(
-            session, "username", access_token=config.GITLAB_TOKEN, url=config.GITLAB_URL
+            session,
+            "username",
+            access_token=config.GITLAB_TOKEN,
+            url=config.GITLAB_URL,
+            cache_identity="apogee",
         )
         kwargs["gl"] = gl
         if wants_session:
@@ -74,16 +97,95 @@ def with_gitlab(fn):
     return wrapped
 
 
-def get_last_pipeline_refresh() -> datetime | None:
-    obj = db.session.execute(
-        db.select(KeyValue).where(KeyValue.key == "last_pipeline_refresh")
-    ).scalar_one_or_none()
-    if obj is None:
-        return None
-    return datetime.fromisoformat(obj.value)
-
-
-def set_last_pipeline_refresh(to: datetime):
-    obj = KeyValue(key="last_pipeline_refresh", value=to.isoformat())
-    db.session.merge(obj)
-    db.session.commit()
+def task_progress(result: AsyncResult, source: str, view: Callable[[], str]) -> str:
+    """
+    Render the progress of a background task, which polls `task_status` until
+    the task is done. Once it is, the result message is flashed and `view` is
+    rendered in place.
+    """
+    if result.ready():
+        if result.failed():
+            flash(f"Task failed: {result.result}", "danger")
+        elif not result.successful():
+            flash(f"Task did not finish ({result.state.lower()})", "danger")
+        elif isinstance(result.result, dict) and "message" in result.result:
+            flash(result.result["message"], "success")
+        else:
+            # e.g. a task that doesn't report back
+            flash("Task finished", "success")
+        result.forget()
+        return view()
+
+    message = None
+    if result.state == "PROGRESS" and isinstance(result.info, dict):
+        message = result.info.get("message")
+
+    return render_template(
+        "task_progress.html",
+        poll_url=url_for(
+            "task_status",
+            task_id=result.id,
+            source=source,
+            before=request.args.get("before"),
+        ),
+        message=message,
+    )
+
+
+CONTENT_VERSION_KEY = "content_version"
+
+
+def bump_content_version() -> None:
+    """
+    Invalidate the ETags of all views after edits that don't show up in the
+    version parts the views check, i.e. notes and patches.
+    """
+    cache.incr(CONTENT_VERSION_KEY)
+
+
+def _add_cache_headers(response: Response, etag: str) -> None:
+    response.set_etag(etag, weak=True)
+    # the browser has to ask every time, but can reuse its copy on a 304
+    response.cache_control.no_cache = True
+    response.vary.update(("HX-Request", "HX-Boosted", "HX-Target"))
+
+
+def check_etag(*parts: Any) -> None:
+    """
+    Answer 304 Not Modified if the client already has the current version of
+    the page. `parts` have to change whenever the data the view renders does,
+    and should be cheap to get, so call this before loading anything else.
+    The ETag is added to the view's response by `add_etag`.
+    """
+    if request.method != "GET" or "_flashes" in web_session:
+        # flashes are shown and consumed by rendering
+        return
+
+    h = hashlib.sha256()
+    for part in (
+        templates_version(),
+        cache.get(CONTENT_VERSION_KEY, 0),
+        request.url,
+        request.headers.get("HX-Request"),
+        request.headers.get("HX-Boosted"),
+        request.headers.get("HX-Target"),
+        g.get("gh_user"),
+        g.get("cern_user"),
+        *parts,
+    ):
+        h.update(repr(part).encode())
+        h.update(b"\0")
+    etag = h.hexdigest()[:32]
+
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+        _add_cache_headers(response, etag)
+        abort(response)
+
+    g.etag = etag
+
+
+def add_etag(response: Response) -> Response:
+    if "etag" in g and response.status_code == 200:
+        _add_cache_headers(response, g.etag)
+    return response
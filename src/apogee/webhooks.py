@@ -0,0 +1,138 @@
+import json
+import logging
+from typing import Any, Dict
+
+from celery import Task
+import pydantic
+
+from apogee import config
+from apogee.model.github import PullRequest
+from apogee.redis_client import get_redis
+from apogee.tasks import (
+    buffer_job_webhook,
+    handle_pipeline_webhook,
+    handle_pull_request,
+    handle_push,
+)
+
+logger = logging.getLogger(__name__)
+
+# the fields the tasks in `apogee.tasks` read, everything else is dropped
+_PIPELINE_FIELDS = (
+    "id",
+    "iid",
+    "sha",
+    "ref",
+    "status",
+    "source",
+    "created_at",
+    "variables",
+)
+_BUILD_FIELDS = (
+    "id",
+    "status",
+    "stage",
+    "name",
+    "allow_failure",
+    "created_at",
+    "started_at",
+    "finished_at",
+    "failure_reason",
+)
+_JOB_FIELDS = (
+    "build_id",
+    "build_status",
+    "build_stage",
+    "build_name",
+    "build_allow_failure",
+    "build_created_at",
+    "build_started_at",
+    "build_finished_at",
+    "build_failure_reason",
+    "pipeline_id",
+    "ref",
+)
+
+
+def slim_pipeline_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    attributes = payload["object_attributes"]
+    return {
+        "object_attributes": {k: attributes[k] for k in _PIPELINE_FIELDS},
+        "project": {"id": payload["project"]["id"]},
+        "builds": [{k: b[k] for k in _BUILD_FIELDS} for b in payload["builds"]],
+    }
+
+
+def slim_job_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: payload[k] for k in _JOB_FIELDS}
+
+
+def slim_push_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    head_commit = payload["head_commit"]
+    return {
+        "installation": {"id": payload["installation"]["id"]},
+        "head_commit": {"id": head_commit["id"]} if head_commit else None,
+        "repository": {"full_name": payload["repository"]["full_name"]},
+    }
+
+
+def slim_pull_request_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        pull_request = PullRequest(**payload["pull_request"]).model_dump(mode="json")
+    except pydantic.ValidationError:
+        # let the task fail on it, with the full payload at hand
+        logger.warning("Could not parse pull request payload", exc_info=True)
+        pull_request = payload["pull_request"]
+    return {
+        "installation": {"id": payload["installation"]["id"]},
+        "action": payload["action"],
+        "pull_request": pull_request,
+    }
+
+
+def is_duplicate_delivery(kind: str, id: int, status: str) -> bool:
+    """
+    Whether the last event we saw for this object had the same status, e.g. a
+    redelivered webhook. Status changes always go through.
+    """
+    r = get_redis()
+    if r is None:
+        return False
+    previous = r.set(
+        f"apogee:webhook:{kind}:{id}",
+        status,
+        ex=config.WEBHOOK_DEDUPLICATION_SECONDS,
+        get=True,
+    )
+    return isinstance(previous, bytes) and previous.decode() == status
+
+
+def enqueue(task: Task, payload: Dict[str, Any]) -> None:
+    options = {}
+    if len(json.dumps(payload)) >= config.WEBHOOK_COMPRESSION_MIN_BYTES:
+        options["compression"] = "zlib"
+    task.apply_async(args=(payload,), **options)
+
+
+def dispatch_gitlab_webhook(body: Dict[str, Any]) -> None:
+    kind = body.get("object_kind")
+    if kind == "pipeline":
+        payload = slim_pipeline_payload(body)
+        attributes = payload["object_attributes"]
+        if is_duplicate_delivery("pipeline", attributes["id"], attributes["status"]):
+            logger.info("Dropping duplicate pipeline event %d", attributes["id"])
+            return
+        enqueue(handle_pipeline_webhook, payload)
+    elif kind == "build":
+        payload = slim_job_payload(body)
+        if is_duplicate_delivery("job", payload["build_id"], payload["build_status"]):
+            logger.info("Dropping duplicate job event %d", payload["build_id"])
+            return
+        buffer_job_webhook(payload)
+
+
+def dispatch_github_webhook(event: str, body: Dict[str, Any]) -> None:
+    if event == "push":
+        enqueue(handle_push, slim_push_payload(body))
+    elif event == "pull_request":
+        enqueue(handle_pull_request, slim_pull_request_payload(body))